@@ -23,12 +23,16 @@ from django.contrib import admin
 from codenerix_email.models import (
     EmailMessage,
     EmailAttachment,
+    EmailDeliveryAttempt,
+    EmailSuppression,
     EmailTemplate,
     MODELS,
 )
 
 admin.site.register(EmailMessage)
 admin.site.register(EmailAttachment)
+admin.site.register(EmailDeliveryAttempt)
+admin.site.register(EmailSuppression)
 admin.site.register(EmailTemplate)
 
 
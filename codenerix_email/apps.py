@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class MyAppConfig(AppConfig):
     default_auto_field = 'django.db.models.AutoField'
     name = 'codenerix_email'
+
+    def ready(self):
+        from codenerix_email import signals  # noqa: F401
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#
+# django-codenerix-email
+#
+# Codenerix GNU
+#
+# Project URL : http://www.codenerix.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class LRUCache:
+    """
+    Thread safe in-process LRU cache holding up to maxsize entries, or up to
+    maxsize total weight if a weigh(value) function is given
+    """
+
+    def __init__(self, maxsize, weigh=None):
+        self.maxsize = maxsize
+        self.weigh = weigh or (lambda value: 1)
+        self.weight = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        weight = self.weigh(value)
+        if weight > self.maxsize:
+            return
+        with self._lock:
+            if key in self._data:
+                self.weight -= self.weigh(self._data[key])
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self.weight += weight
+            while self.weight > self.maxsize:
+                (_, old) = self._data.popitem(last=False)
+                self.weight -= self.weigh(old)
+
+    def discard(self, match):
+        """
+        Remove all entries whose key matches
+        """
+        with self._lock:
+            for key in [key for key in self._data if match(key)]:
+                self.weight -= self.weigh(self._data.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Compiled EmailTemplate texts by (pk, language, updated)
+templates = LRUCache(
+    getattr(settings, "CLIENT_EMAIL_TEMPLATE_CACHE_SIZE", 128)
+)
+
+# Base64 encoded attachments by SHA-256 of their content, up to
+# CLIENT_EMAIL_ATTACHMENT_CACHE_SIZE bytes
+attachments = LRUCache(
+    getattr(settings, "CLIENT_EMAIL_ATTACHMENT_CACHE_SIZE", 64 * 1024 * 1024),
+    weigh=len,
+)
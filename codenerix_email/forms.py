@@ -73,9 +73,10 @@ class EmailMessageForm(GenModelForm):
         model = EmailMessage
         exclude = [
             "sending",
-            "log",
+            "legacy_log",
             "opened",
             "unsubscribe_url",
+            "tracking",
             "bounces_total",
             "bounces_soft",
             "bounces_hard",
@@ -127,7 +128,7 @@ class EmailMessageForm(GenModelForm):
                 ["sending", 3],
                 ["sent", 3],
                 ["error", 3],
-                ["log", 3],
+                ["log", 3, _("Log")],
                 ["content_subtype", 3],
                 ["unsubscribe_url", 3],
                 ["headers", 3],
@@ -0,0 +1,696 @@
+# -*- coding: utf-8 -*-
+#
+# django-codenerix-email
+#
+# Codenerix GNU
+#
+# Project URL : http://www.codenerix.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import time
+import socket
+import asyncio
+import threading
+import statistics
+import socketserver
+from textwrap import dedent
+from argparse import RawTextHelpFormatter
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+from asgiref.sync import sync_to_async
+from django.core import mail
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import transaction, connections, router
+from django.db.backends.signals import connection_created
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from codenerix_lib.debugger import Debugger
+from codenerix_email.models import (
+    EmailMessage,
+    EmailAttachment,
+    EmailDeliveryAttempt,
+)
+from codenerix_email.management.commands.emails_send import (
+    Command as SendCommand,
+)
+
+# Sender of the emails created by the send benchmark
+BENCH_FROM = "bench@example.com"
+
+# Most queries the bucket benchmark allows by default for every bucket
+# (leases, claim, status, attempts, savepoints) and for every chunk of
+# CLIENT_EMAIL_LOAD_CHUNK emails (the emails and their attachments), plus
+# one compare-and-swap per email where SKIP LOCKED isn't available
+BUCKET_QUERIES = 10
+CHUNK_QUERIES = 4
+
+# Options of emails_send for every mode of the send benchmark
+SEND_MODES = {
+    "sequential": [],
+    "keep-alive": ["--keep-alive"],
+    "workers": ["--keep-alive", "--workers", "{workers}"],
+    "async": ["--async", "--workers", "{workers}"],
+    "grouped": ["--keep-alive"],
+}
+
+
+class Rollback(Exception):
+    """
+    Raised to discard everything the benchmark wrote in the database
+    """
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """
+    Accept every email and throw it away
+    """
+
+    def setup(self):
+        super().setup()
+        # Answer at once, small replies must not wait for delayed ACKs
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def reply(self, *lines):
+        self.wfile.write(
+            b"".join(line.encode("ascii") + b"\r\n" for line in lines)
+        )
+
+    def handle(self):
+        self.reply("220 localhost codenerix-email benchmark")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line[:4].upper()
+            if command == b"EHLO":
+                self.reply("250-localhost", "250-8BITMIME", "250 SMTPUTF8")
+            elif command == b"DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line == b".\r\n":
+                        break
+                self.server.received()
+                self.reply("250 OK")
+            elif command == b"QUIT":
+                self.reply("221 Bye")
+                break
+            else:
+                # HELO, MAIL, RCPT, RSET, NOOP...
+                self.reply("250 OK")
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """
+    Local SMTP server standing in for the relay, every DATA takes latency
+    seconds more to answer
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0):
+        super().__init__(("127.0.0.1", 0), SMTPSinkHandler)
+        self.latency = latency
+        self.messages = 0
+        self._lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def received(self):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.messages += 1
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class QueryCounter:
+    """
+    Count the queries run on the database connections of this thread and on
+    those opened by any thread while counting
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.wrapped = []
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def wrap(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+            self.wrapped.append(connection)
+
+    def __enter__(self):
+        for connection in connections.all():
+            self.wrap(connection=connection)
+        connection_created.connect(self.wrap)
+        return self
+
+    def __exit__(self, *exc):
+        connection_created.disconnect(self.wrap)
+        for connection in self.wrapped:
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+        self.wrapped = []
+        return False
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of values
+    """
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def peak_rss():
+    """
+    Peak resident memory of this process in MB, None if unknown
+    """
+    if resource is None:
+        return None
+    # KB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if peak > 1 << 32:
+        peak //= 1024
+    return peak / 1024
+
+
+class Command(BaseCommand, Debugger):
+    # Show this when the user types help
+    help = "Benchmark the email queue"
+
+    def create_parser(self, prog_name, subcommand, **kwargs):
+        parser = super().create_parser(prog_name, subcommand, **kwargs)
+        parser.formatter_class = RawTextHelpFormatter
+        return parser
+
+    def add_arguments(self, parser):
+        parser.epilog = dedent(r"""
+            Benchmarks:
+                queue: time the query used to poll the queue while the
+                       history of sent emails grows, it should not grow
+                       with the history.
+                bucket: count the queries emails_send needs to deliver a
+                        bucket (to an in-memory backend), it should not
+                        grow with the size of the bucket. It fails when a
+                        bucket needs more than --max-queries (by default
+                        a bound for the database in use, 24 for a bucket
+                        of 10 on SQLite).
+                send: deliver --pending emails with emails_send to a local
+                      SMTP sink in every mode (sequential, keep-alive,
+                      workers, async and grouped), showing emails per
+                      second, SMTP latency (p50/p99), queries per email and
+                      the peak memory of the process (run one mode at a
+                      time to get the peak of each one). A mode fails if
+                      any email is not delivered, so "send --modes async"
+                      checks the asyncio engine (EmailMessage.asend()) end
+                      to end. The grouped mode queues emails without
+                      tracking and fails if none of them shared a
+                      transaction.
+
+            All rows created by the queue and bucket benchmarks are rolled
+            back at the end. The send benchmark needs the queue empty of
+            other emails (use a test database), it deletes its own emails
+            when done.
+
+            Examples:
+                python manage.py emails_bench queue
+                python manage.py emails_bench queue --history 0,10000,100000
+                python manage.py emails_bench bucket --bucket 100
+                python manage.py emails_bench bucket --max-queries 10
+                python manage.py emails_bench send --pending 1000
+                python manage.py emails_bench send --modes workers,async \
+                    --workers 8 --latency 20 --attachments 1
+            """)
+        parser.add_argument(
+            "benchmark",
+            choices=["queue", "bucket", "send"],
+            help="Benchmark to run",
+        )
+        parser.add_argument(
+            "--history",
+            type=str,
+            default="0,1000,10000,100000",
+            help="Comma separated sizes of the sent history to try",
+        )
+        parser.add_argument(
+            "--pending",
+            type=int,
+            default=100,
+            help="Emails waiting in the queue",
+        )
+        parser.add_argument(
+            "--runs",
+            type=int,
+            default=50,
+            help="Times every query is run",
+        )
+        parser.add_argument(
+            "--bucket",
+            type=int,
+            default=None,
+            help="Emails in each bucket (default CLIENT_EMAIL_BUCKETS)",
+        )
+        parser.add_argument(
+            "--max-queries",
+            type=int,
+            default=None,
+            help="Fail if a bucket needs more queries than this (default "
+            "a bound for the database and the size of the bucket)",
+        )
+        parser.add_argument(
+            "--modes",
+            type=str,
+            default=",".join(SEND_MODES),
+            help="Comma separated modes of emails_send to benchmark",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Workers of the workers and async modes",
+        )
+        parser.add_argument(
+            "--body-size",
+            type=int,
+            default=2048,
+            help="Bytes in the body of every email",
+        )
+        parser.add_argument(
+            "--attachments",
+            type=int,
+            default=0,
+            help="Attachments of every email",
+        )
+        parser.add_argument(
+            "--attachment-size",
+            type=int,
+            default=65536,
+            help="Bytes in every attachment",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0,
+            help="Milliseconds the SMTP sink takes to accept every email",
+        )
+        parser.add_argument(
+            "--explain",
+            action="store_true",
+            default=False,
+            help="Show the query plan",
+        )
+
+    def handle(self, *args, **options):
+        # Autoconfigure Debugger
+        self.set_name("CODENERIX-EMAIL")
+        self.set_debug()
+
+        try:
+            history = sorted(
+                int(x) for x in options["history"].split(",") if x.strip()
+            )
+        except ValueError:
+            raise CommandError(
+                f"History must be a list of numbers: {options['history']}"
+            )
+
+        if options["benchmark"] == "send":
+            modes = [x.strip() for x in options["modes"].split(",") if x]
+            unknown = set(modes) - set(SEND_MODES)
+            if unknown:
+                raise CommandError(
+                    f"Unknown modes: {', '.join(sorted(unknown))} (use "
+                    f"{', '.join(SEND_MODES)})"
+                )
+            self.bench_send(
+                modes,
+                options["pending"],
+                options["workers"],
+                options["body_size"],
+                options["attachments"],
+                options["attachment_size"],
+                options["latency"] / 1000,
+            )
+            return
+
+        try:
+            with transaction.atomic():
+                if options["benchmark"] == "queue":
+                    self.bench_queue(
+                        history,
+                        options["pending"],
+                        options["runs"],
+                        options["explain"],
+                    )
+                elif options["benchmark"] == "bucket":
+                    self.bench_bucket(
+                        options["pending"],
+                        options["runs"],
+                        options["bucket"],
+                        options["max_queries"],
+                    )
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def seed(self, total, **kwargs):
+        """
+        Create total emails in the database
+        """
+        batch = 1000
+        while total > 0:
+            size = min(batch, total)
+            EmailMessage.objects.bulk_create(
+                [
+                    EmailMessage(
+                        efrom="bench@example.com",
+                        eto="bench@example.com",
+                        subject="Benchmark",
+                        body="Benchmark",
+                        **kwargs,
+                    )
+                    for _ in range(size)
+                ]
+            )
+            total -= size
+
+    def bench_queue(self, history, pending, runs, explain):
+        bucket_size = getattr(settings, "CLIENT_EMAIL_BUCKETS", 10)
+
+        # Emails waiting in the queue
+        self.seed(pending)
+
+        self.debug(
+            f"Polling a bucket of {bucket_size} from {pending} pending "
+            f"emails ({runs} runs)",
+            color="blue",
+        )
+        seeded = 0
+        for size in history:
+            # Grow the history of sent emails
+            self.seed(size - seeded, sent=True)
+            seeded = size
+
+            # Time the poll
+            query = EmailMessage.pending()[:bucket_size].values_list(
+                "pk", flat=True
+            )
+            timings = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                list(query.all())
+                timings.append((time.perf_counter() - start) * 1000)
+
+            self.debug(
+                f"History {size:>10}: "
+                f"median {statistics.median(timings):.3f} ms - "
+                f"max {max(timings):.3f} ms",
+                color="white",
+            )
+
+        if explain:
+            self.debug(query.explain(), color="cyan")
+
+    def bench_bucket(self, pending, runs, bucket_size, max_queries):
+        if bucket_size is None:
+            bucket_size = getattr(settings, "CLIENT_EMAIL_BUCKETS", 10)
+        max_retries = getattr(settings, "CLIENT_EMAIL_RETRIES", 10)
+
+        # Emails waiting in the queue
+        self.seed(max(pending, bucket_size * runs))
+
+        # Deliver through the sender of emails_send to an in-memory backend
+        sender = SendCommand()
+        sender.set_name("CODENERIX-EMAIL")
+        sender.set_debug()
+        connection = mail.get_connection(
+            "django.core.mail.backends.locmem.EmailBackend"
+        )
+        db = connections[router.db_for_write(EmailMessage)]
+
+        self.debug(
+            f"Delivering buckets of {bucket_size} emails ({runs} runs)",
+            color="blue",
+        )
+        counts = []
+        for _ in range(runs):
+            with CaptureQueriesContext(db) as queries:
+                pks = EmailMessage.claim(limit=bucket_size, sendnow=True)
+                sender.send_bucket(
+                    pks, connection, False, 1, False, max_retries
+                )
+            mail.outbox.clear()
+            counts.append(len(queries))
+
+        self.debug(
+            f"Queries per bucket: median {statistics.median(counts)} - "
+            f"max {max(counts)} - "
+            f"{statistics.median(counts) / bucket_size:.2f} per email",
+            color="white",
+        )
+
+        if max_queries is None:
+            max_queries = self.max_bucket_queries(db, bucket_size)
+        if max(counts) > max_queries:
+            raise CommandError(
+                f"A bucket needed {max(counts)} queries, "
+                f"more than {max_queries}"
+            )
+
+    def max_bucket_queries(self, db, bucket_size):
+        """
+        Most queries delivering a bucket of bucket_size emails should need
+        on the database db
+        """
+        chunk_size = getattr(settings, "CLIENT_EMAIL_LOAD_CHUNK", 50)
+        queries = BUCKET_QUERIES + CHUNK_QUERIES * math.ceil(
+            bucket_size / chunk_size
+        )
+        if not db.features.has_select_for_update_skip_locked:
+            # EmailMessage.claim() swaps the emails one by one
+            queries += bucket_size
+        return queries
+
+    def seed_send(
+        self, total, body_size, attachments, attachment_size, tracking=True
+    ):
+        """
+        Create total emails to be sent with attachments sharing the same
+        stored file, returns the name of that file. Only emails without
+        tracking can be grouped in one transaction.
+        """
+        body = ("Benchmark " * (body_size // 10 + 1))[:body_size]
+        name = None
+        if attachments:
+            content = ContentFile(
+                (b"codenerix-email " * (attachment_size // 16 + 1))[
+                    :attachment_size
+                ],
+                name="bench.bin",
+            )
+            name, sha256 = EmailAttachment.store(content, "bench.bin")
+
+        batch = 1000
+        for start in range(0, total, batch):
+            emails = EmailMessage.objects.bulk_create(
+                [
+                    EmailMessage(
+                        efrom=BENCH_FROM,
+                        eto=f"bench{position}@example.com",
+                        subject="Benchmark",
+                        body=body,
+                        headers={},
+                        tracking=tracking,
+                    )
+                    for position in range(start, min(start + batch, total))
+                ]
+            )
+            if attachments:
+                EmailAttachment.objects.bulk_create(
+                    [
+                        EmailAttachment(
+                            email=email,
+                            filename=f"bench{position}.bin",
+                            mime="application/octet-stream",
+                            path=name,
+                            sha256=sha256,
+                        )
+                        for email in emails
+                        for position in range(attachments)
+                    ]
+                )
+        return name
+
+    def clean_send(self, name):
+        """
+        Delete the emails of the send benchmark and their attachment
+        """
+        EmailMessage.objects.filter(efrom=BENCH_FROM).delete()
+        if name and not EmailAttachment.objects.filter(path=name).exists():
+            EmailAttachment._meta.get_field("path").storage.delete(name)
+
+    def bench_send(
+        self,
+        modes,
+        total,
+        workers,
+        body_size,
+        attachments,
+        attachment_size,
+        latency,
+    ):
+        # Do not send anybody's emails to the sink
+        if (
+            EmailMessage.objects.filter(sent=False, error=False)
+            .exclude(efrom=BENCH_FROM)
+            .exists()
+        ):
+            raise CommandError(
+                "There are emails waiting in the queue, run the send "
+                "benchmark against an empty queue (like a test database)"
+            )
+
+        sink = SMTPSink(latency)
+        sink.start()
+        smtp = {
+            "EMAIL_BACKEND": "django.core.mail.backends.smtp.EmailBackend",
+            "CLIENT_EMAIL_HOST": "127.0.0.1",
+            "CLIENT_EMAIL_PORT": sink.port,
+            "CLIENT_EMAIL_USERNAME": None,
+            "CLIENT_EMAIL_PASSWORD": None,
+            "CLIENT_EMAIL_USE_TLS": False,
+            "CLIENT_EMAIL_USE_SSL": False,
+            "CLIENT_EMAIL_HISTORY": True,
+        }
+
+        self.debug(
+            f"Sending {total} emails of {body_size} bytes with "
+            f"{attachments} attachments of {attachment_size} bytes "
+            f"({latency * 1000:.0f} ms of SMTP latency)",
+            color="blue",
+        )
+        failed = []
+        try:
+            for mode in modes:
+                name = self.seed_send(
+                    total,
+                    body_size,
+                    attachments,
+                    attachment_size,
+                    tracking=mode != "grouped",
+                )
+                transactions = sink.messages
+                args = [
+                    arg.format(workers=workers) for arg in SEND_MODES[mode]
+                ]
+                try:
+                    with override_settings(
+                        CLIENT_EMAIL_GROUP_IDENTICAL=mode == "grouped", **smtp
+                    ):
+                        with QueryCounter() as queries:
+                            start = time.perf_counter()
+                            call_command(
+                                "emails_send", "--all", "--now", *args
+                            )
+                            elapsed = time.perf_counter() - start
+                            if mode == "async":
+                                # Close the connection of the thread used by
+                                # sync_to_async, so the next run counts it
+                                asyncio.run(
+                                    sync_to_async(connections.close_all)()
+                                )
+                except Exception as e:
+                    self.debug(f"{mode:>10}: FAILED ({e})", color="red")
+                    failed.append(mode)
+                    continue
+                finally:
+                    sent = EmailMessage.objects.filter(
+                        efrom=BENCH_FROM, sent=True
+                    ).count()
+                    durations = [
+                        duration * 1000
+                        for duration in EmailDeliveryAttempt.objects.filter(
+                            email__efrom=BENCH_FROM, sent=True
+                        ).values_list("duration", flat=True)
+                        if duration is not None
+                    ]
+                    errors = EmailDeliveryAttempt.objects.filter(
+                        email__efrom=BENCH_FROM, sent=False
+                    ).count()
+                    self.clean_send(name)
+                transactions = sink.messages - transactions
+
+                if sent < total or errors:
+                    # The sink accepts everything, nothing may fail
+                    self.debug(
+                        f"{mode:>10}: FAILED ({sent}/{total} sent, {errors} "
+                        "failed attempts)",
+                        color="red",
+                    )
+                    failed.append(mode)
+                    continue
+
+                if mode == "grouped" and sent > 1 and transactions >= sent:
+                    # Every email went in its own transaction
+                    self.debug(
+                        f"{mode:>10}: FAILED (no emails were grouped, "
+                        f"{transactions} transactions for {sent} emails)",
+                        color="red",
+                    )
+                    failed.append(mode)
+                    continue
+
+                rss = peak_rss()
+                self.debug(
+                    f"{mode:>10}: {sent}/{total} sent "
+                    f"in {transactions} transactions - "
+                    f"{sent / elapsed:.1f} emails/s - "
+                    f"p50 {percentile(durations, 50):.2f} ms - "
+                    f"p99 {percentile(durations, 99):.2f} ms - "
+                    f"{queries.count / max(sent, 1):.2f} queries/email - "
+                    + (f"peak RSS {rss:.1f} MB" if rss else "peak RSS n/a"),
+                    color="white",
+                )
+        finally:
+            sink.stop()
+
+        if failed:
+            raise CommandError(f"Failed modes: {', '.join(failed)}")
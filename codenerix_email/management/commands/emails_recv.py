@@ -1,4 +1,5 @@
 import re
+import time
 import codecs
 from textwrap import dedent
 from argparse import RawTextHelpFormatter
@@ -21,6 +22,7 @@ from codenerix_email.models import (
     BOUNCE_SOFT,
     BOUNCE_HARD,
 )
+from codenerix_email import metrics
 
 
 # Silence DEBUG logs from imapclient
@@ -207,6 +209,13 @@ class Command(BaseCommand):
         parser.add_argument(
             "--file", type=str, help="Path to a file containing raw email data"
         )
+        parser.add_argument(
+            "--metrics-file",
+            type=str,
+            default=getattr(settings, "IMAP_EMAIL_METRICS_FILE", None),
+            help="Write Prometheus metrics to this file when done (for the "
+            "textfile collector of node_exporter)",
+        )
 
     def validate_encoding(self, encoding: str | None) -> str:
         """
@@ -236,6 +245,20 @@ class Command(BaseCommand):
         self.rewrite = options.get("rewrite", False)
         self.process_all = options.get("all", False)
         self.file_path = options.get("file")
+        metrics_file = options.get("metrics_file")
+
+        try:
+            self.synchronize()
+        finally:
+            # Export the metrics of this run
+            if metrics_file:
+                metrics.RECV_LAST_RUN.set(time.time())
+                metrics.write_textfile(metrics_file)
+
+    def synchronize(self):
+        """
+        Fetch and save the new emails from the configured IMAP account
+        """
 
         # Show header
         if self.verbose:
@@ -271,7 +294,8 @@ class Command(BaseCommand):
 
             try:
                 # Connect to the IMAP server
-                server = imapcls(host, port=port, ssl=ssl)
+                with metrics.IMAP_SECONDS.time(operation="connect"):
+                    server = imapcls(host, port=port, ssl=ssl)
             except Exception as e:
                 raise CommandError(
                     f"Failed to connect to IMAP server ("
@@ -284,7 +308,8 @@ class Command(BaseCommand):
             try:
                 # Login and select the inbox
                 try:
-                    server.login(user, password)
+                    with metrics.IMAP_SECONDS.time(operation="login"):
+                        server.login(user, password)
                 except LoginError as e:
                     raise CommandError(
                         f"Failed to login to IMAP server with {user=}: {e}"
@@ -396,9 +421,10 @@ class Command(BaseCommand):
         # If there are new messages, fetch and process them
         if messages_ids:
             # Fetch the full message and internal date
-            fetched_data = server.fetch(
-                messages_ids, ["BODY.PEEK[]", "INTERNALDATE"]
-            )
+            with metrics.IMAP_SECONDS.time(operation="fetch"):
+                fetched_data = server.fetch(
+                    messages_ids, ["BODY.PEEK[]", "INTERNALDATE"]
+                )
 
             # Get the envelope (metadata) and the full body
             # Use IMAP IDs so identifiers do not change between sessions
@@ -589,6 +615,12 @@ class Command(BaseCommand):
                     if email_message:
                         email_message.recalculate_bounces()
 
+                    metrics.RECEIVED.inc(
+                        bounce={BOUNCE_HARD: "hard", BOUNCE_SOFT: "soft"}.get(
+                            bounce_type, "none"
+                        )
+                    )
+
                     # Count created or overwritten
                     if overwriting:
                         overwrite_count += 1
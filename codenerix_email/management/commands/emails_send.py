@@ -19,13 +19,26 @@
 # limitations under the License.
 
 import time
+import asyncio
+import threading
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 
 from django.core.management.base import BaseCommand
 from django.conf import settings
-from django.utils import timezone
+from django.db import connections
+from asgiref.sync import sync_to_async
 
 from codenerix_lib.debugger import Debugger
-from codenerix_email.models import EmailMessage
+from codenerix_email.models import (
+    EmailMessage,
+    LeaseHeartbeat,
+    StatusBuffer,
+)
+from codenerix_email.wakeup import get_channel
+from codenerix_email.throttle import get_throttle
+from codenerix_email.smtp import get_pool
+from codenerix_email import metrics
 
 
 class Command(BaseCommand, Debugger):
@@ -66,7 +79,9 @@ class Command(BaseCommand, Debugger):
             action="store_true",
             dest="clear",
             default=False,
-            help="Clear the sending status to all the Queue",
+            help="Clear the sending status to all the Queue (do not use it "
+            "while other workers are sending, emails of dead workers go back "
+            "to the queue after CLIENT_EMAIL_LEASE seconds anyway)",
         )
         # Named (optional) arguments
         parser.add_argument(
@@ -100,6 +115,49 @@ class Command(BaseCommand, Debugger):
             default=False,
             help="Retry all, do not wait the retry time and do not check retries",
         )
+        # Named (optional) arguments
+        parser.add_argument(
+            "--keep-alive",
+            action="store_true",
+            dest="keep_alive",
+            default=False,
+            help="Keep the SMTP session open between emails",
+        )
+        # Named (optional) arguments
+        parser.add_argument(
+            "--workers",
+            type=int,
+            dest="workers",
+            default=getattr(settings, "CLIENT_EMAIL_WORKERS", 1),
+            help="Number of threads delivering each bucket in parallel, "
+            "each one with its own SMTP session (concurrent SMTP sessions "
+            "when using --async), up to CLIENT_EMAIL_POOL_SIZE",
+        )
+        # Named (optional) arguments
+        parser.add_argument(
+            "--async",
+            action="store_true",
+            dest="use_async",
+            default=False,
+            help="Deliver with asyncio from a single thread (requires "
+            "aiosmtplib)",
+        )
+        # Named (optional) arguments
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            dest="metrics_port",
+            default=getattr(settings, "CLIENT_EMAIL_METRICS_PORT", None),
+            help="Expose Prometheus metrics over HTTP on this port",
+        )
+        # Named (optional) arguments
+        parser.add_argument(
+            "--metrics-file",
+            dest="metrics_file",
+            default=getattr(settings, "CLIENT_EMAIL_METRICS_FILE", None),
+            help="Write Prometheus metrics to this file (for the textfile "
+            "collector of node_exporter)",
+        )
 
     def handle(self, *args, **options):
         # Get user configuration
@@ -110,6 +168,12 @@ class Command(BaseCommand, Debugger):
         sendnow = bool(options.get("now", False))
         doall = bool(options.get("all", False))
         retry_all = bool(options.get("retry_all", False))
+        keep_alive = bool(
+            options.get("keep_alive", False)
+            or getattr(settings, "CLIENT_EMAIL_KEEP_ALIVE", False)
+        )
+        workers = max(1, int(options.get("workers") or 1))
+        use_async = bool(options.get("use_async", False))
 
         # Autoconfigure Debugger
         self.set_name("CODENERIX-EMAIL")
@@ -136,68 +200,230 @@ class Command(BaseCommand, Debugger):
 
         # In if requested set sending status for all the list to False
         if clear:
-            EmailMessage.objects.filter(sending=True).update(sending=False)
+            EmailMessage.objects.filter(sending=True).update(
+                sending=False, lease_until=None
+            )
+
+        # No more workers than sessions the pool allows to the relay
+        if workers > get_pool().size:
+            self.warning(
+                f"Requested {workers} workers but CLIENT_EMAIL_POOL_SIZE "
+                f"allows {get_pool().size} SMTP sessions, running "
+                f"{get_pool().size} workers (raise CLIENT_EMAIL_POOL_SIZE if "
+                "the relay accepts more)"
+            )
+            workers = get_pool().size
 
         # System retries
         max_retries = getattr(settings, "CLIENT_EMAIL_RETRIES", 10)
 
+        # Export the metrics if requested
+        self.start_metrics(
+            options.get("metrics_port"), options.get("metrics_file")
+        )
+
+        # Channel to get notified when new emails arrive
+        channel = get_channel()
+
+        # Deliver with asyncio if requested
+        if use_async:
+            try:
+                asyncio.run(
+                    self.run_async(
+                        daemon,
+                        doall,
+                        bucket_size,
+                        retry_all,
+                        sendnow,
+                        workers,
+                        verbose,
+                        max_retries,
+                        channel,
+                    )
+                )
+            except KeyboardInterrupt:
+                self.debug("Exited by user request!", color="green")
+            finally:
+                channel.close()
+                self.stop_metrics()
+            return
+
         # Get a bunch of emails in the queue
         connection = None
 
         # If daemon mode is requested
         first = True
         while first or daemon:
-            # Get a bucket of emails
-            emails = EmailMessage.objects.filter(
-                sent=False,
-                sending=False,
-                error=False,
-            )
+            if verbose:
+                queued = EmailMessage.pending(
+                    retry_all=retry_all, sendnow=sendnow
+                ).count()
+                if queued:
+                    self.debug(
+                        f"There are {queued} emails "
+                        "to be sent in the queue",
+                        color="cyan",
+                    )
 
-            # If we do not have to retry all we have to check the retries
-            if not retry_all:
-                emails = emails.filter(retries__lt=max_retries)
+            # Claim a bucket of emails (all of them if not using buckets),
+            # other workers will not get these emails
+            list_emails = self.claim(doall, bucket_size, retry_all, sendnow)
 
-            # If we do not have to send now we have to wait for the next retry
-            if not sendnow:
-                emails = emails.filter(
-                    next_retry__lte=timezone.now(),
+            # Check if there are emails to process
+            if list_emails:
+                connection = self.send_bucket(
+                    list_emails,
+                    connection,
+                    keep_alive,
+                    workers,
+                    verbose,
+                    max_retries,
                 )
 
-            if verbose and emails:
+            elif daemon:
+                # Do not keep the session open while idle
+                if keep_alive and connection:
+                    connection.close()
+                get_pool().close()
+
+                # Sleep until there is something to send
+                try:
+                    self.wait(channel, retry_all)
+                except KeyboardInterrupt:
+                    self.debug("Exited by user request!", color="green")
+                    break
+
+            elif verbose:
+                # No emails to send
                 self.debug(
-                    f"There are {emails.count()} emails "
-                    "to be sent in the queue",
-                    color="cyan",
+                    "No emails to be sent at this moment in the queue!",
+                    color="green",
                 )
 
-            # Order emails by priority and next retry
-            emails = emails.order_by("priority", "next_retry")
+            # Refresh the metrics file
+            self.export_metrics()
 
-            # Send in buckets if we are not doing them all
-            if not doall:
-                emails = emails[0 : bucket_size + 1]
-
-            # Check if there are emails to process
-            if emails:
+            # This was the first time
+            first = False
 
-                # Show the number of emails to be sent in this batch
-                if verbose:
-                    self.debug(
-                        f"Sending {emails.count()} emails in this batch",
-                        color="cyan",
-                    )
+        # Close the session we kept open
+        if keep_alive and connection:
+            connection.close()
+        get_pool().close()
+        channel.close()
+        self.stop_metrics()
+
+    def start_metrics(self, port, path):
+        """
+        Serve the metrics over HTTP on port and/or write them to path
+        """
+        self.metrics_server = None
+        self.metrics_file = path
+        self.metrics_written = None
+        if port or path:
+            # Counting the sent emails goes through the whole history
+            sent = getattr(settings, "CLIENT_EMAIL_METRICS_SENT", False)
+            metrics.QUEUE.set_function(
+                lambda: {
+                    (state,): count
+                    for (state, count) in EmailMessage.queue_depth(
+                        sent=sent
+                    ).items()
+                }
+            )
+        if port:
+            self.metrics_server = metrics.serve(port)
+
+    def export_metrics(self, force=False):
+        """
+        Write the metrics file, at most every CLIENT_EMAIL_METRICS_INTERVAL
+        seconds unless forced
+        """
+        if not self.metrics_file:
+            return
+        interval = getattr(settings, "CLIENT_EMAIL_METRICS_INTERVAL", 15)
+        now = time.monotonic()
+        if (
+            force
+            or self.metrics_written is None
+            or now - self.metrics_written >= interval
+        ):
+            metrics.write_textfile(self.metrics_file)
+            self.metrics_written = now
+
+    def stop_metrics(self):
+        self.export_metrics(force=True)
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+
+    def claim(self, doall, bucket_size, retry_all, sendnow):
+        """
+        Claim the next bucket of emails, see EmailMessage.claim()
+        """
+        with metrics.CLAIM_SECONDS.time():
+            return EmailMessage.claim(
+                limit=None if doall else bucket_size,
+                retry_all=retry_all,
+                sendnow=sendnow,
+            )
 
-                # Convert to list
-                list_emails = [x.pk for x in emails]
+    def send_bucket(
+        self,
+        list_emails,
+        connection,
+        keep_alive,
+        workers,
+        verbose,
+        max_retries,
+    ):
+        """
+        Deliver a bucket of emails claimed with EmailMessage.claim(), returns
+        the connection to keep using for the next bucket
+        """
+
+        # Show the number of emails to be sent in this batch
+        if verbose:
+            self.debug(
+                f"Sending {len(list_emails)} emails in this batch",
+                color="cyan",
+            )
 
-                # Set sending status for all the list
-                EmailMessage.objects.filter(pk__in=list_emails).update(
-                    sending=True
+        # Get the claimed emails
+        emails = EmailMessage.claimed(list_emails)
+        status = StatusBuffer()
+        throttle = get_throttle()
+        heartbeat = LeaseHeartbeat(list_emails).start()
+
+        try:
+            if workers > 1:
+                # Deliver the bucket in parallel, with no more threads than
+                # sessions in the pool
+                self.send_parallel(
+                    emails,
+                    min(workers, len(list_emails), get_pool().size),
+                    verbose,
+                    max_retries,
                 )
-
+            elif getattr(settings, "CLIENT_EMAIL_GROUP_IDENTICAL", False):
+                # Deliver the emails with the same content together
+                connection = self.send_grouped(
+                    emails,
+                    connection,
+                    keep_alive,
+                    status,
+                    verbose,
+                    max_retries,
+                )
+            else:
                 # For each email
                 for email in emails:
+                    # Respect the rate of the recipient's domain
+                    if self.throttled(email, throttle, verbose):
+                        status.add(email)
+                        continue
+
                     if verbose:
                         self.debug(
                             f"Sending to {email.eto}",
@@ -214,20 +440,19 @@ class Command(BaseCommand, Debugger):
                                 head=False,
                                 tail=False,
                             )
-                        connection = email.connect()
+                        if keep_alive:
+                            connection = EmailMessage.persistent_connect()
+                        else:
+                            connection = email.connect()
 
                     # Send the email
                     try:
-                        email.send(connection, debug=False)
+                        email.send(connection, debug=False, commit=False)
                     except Exception as e:
-                        email.sending = False
-                        error = f"Exception: {e}\n"
-                        if email.log:
-                            email.log += error
-                        else:
-                            email.log = error
-                        email.save()
-                        self.error(error)
+                        self.failed(email, e)
+                    finally:
+                        throttle.release(email.eto)
+                    status.add(email)
                     if verbose:
                         if email.sent:
                             self.debug(" -> SENT", color="green", head=False)
@@ -244,27 +469,304 @@ class Command(BaseCommand, Debugger):
                                 color="cyan",
                                 head=False,
                             )
+        finally:
+            # Save the outcome and give back to the queue whatever
+            # we didn't process
+            status.flush()
+            EmailMessage.release(list_emails)
+            heartbeat.stop()
+
+        # Delete all that have been sent
+        if not getattr(settings, "CLIENT_EMAIL_HISTORY", True):
+            EmailMessage.objects.filter(pk__in=list_emails, sent=True).delete()
+
+        return connection
+
+    def wait(self, channel, retry_all):
+        """
+        Sleep until notified of new emails or until the next one is due
+        """
+        timeout = channel.max_wait
+        due = EmailMessage.next_due(retry_all)
+        if due is not None:
+            timeout = min(timeout, max(due, 0.1))
+        return channel.wait(timeout)
+
+    def send_grouped(
+        self, emails, connection, keep_alive, status, verbose, max_retries
+    ):
+        """
+        Deliver the emails with the same content in a single SMTP transaction
+        per group (see EmailMessage.send_group()), returns the connection
+        """
+        throttle = get_throttle()
+        for group in EmailMessage.grouped(emails):
+            # Respect the rate of every recipient's domain
+            allowed = []
+            for email in group:
+                if self.throttled(email, throttle, verbose):
+                    status.add(email)
+                else:
+                    allowed.append(email)
+            if not allowed:
+                continue
+
+            if not connection:
+                if keep_alive:
+                    connection = EmailMessage.persistent_connect()
+                else:
+                    connection = allowed[0].connect()
+
+            try:
+                if len(allowed) > 1:
+                    EmailMessage.send_group(allowed, connection)
+                else:
+                    allowed[0].send(connection, debug=False, commit=False)
+            except Exception as e:
+                for email in allowed:
+                    if not email.sent:
+                        self.failed(email, e)
+            finally:
+                for email in allowed:
+                    throttle.release(email.eto)
+            for email in allowed:
+                status.add(email)
+                if verbose:
+                    self.report(email, max_retries)
+        return connection
+
+    def throttled(self, email, throttle, verbose):
+        """
+        Defer the email if its domain can not get more emails right now,
+        returns True if it was deferred (otherwise release the throttle
+        after sending it)
+        """
+        delay = throttle.acquire(email.eto)
+        if delay:
+            email.defer(delay)
+            if verbose:
+                self.debug(
+                    f"Sending to {email.eto} -> DEFERRED ({delay:.1f}s)",
+                    color="yellow",
+                )
+            return True
+        return False
+
+    def failed(self, email, e):
+        """
+        Record an unexpected exception while sending an email
+        """
+        email.sending = False
+        error = f"Exception: {e}\n"
+        email.add_attempt(error, e)
+        self.error(error)
+
+    def report(self, email, max_retries):
+        """
+        Show in one line how the delivery of an email went
+        """
+        if email.sent:
+            self.debug(f"Sending to {email.eto} -> SENT", color="green")
+        else:
+            self.debug(
+                f"Sending to {email.eto} -> ERROR "
+                f"({max_retries - email.retries} retries left)",
+                color="red",
+            )
 
-                # Delete all that have been sent
-                if not getattr(settings, "CLIENT_EMAIL_HISTORY", True):
-                    EmailMessage.objects.filter(
-                        pk__in=list_emails, sent=True
-                    ).delete()
+    def send_parallel(self, emails, workers, verbose, max_retries):
+        """
+        Deliver the emails (an iterator) with a pool of threads, each one
+        with its own SMTP session checked out from the shared pool (so no
+        more than CLIENT_EMAIL_POOL_SIZE are open), and save their outcome
+        in batches
+        """
+
+        # The threads take the emails from the iterator as they need them
+        lock = threading.Lock()
+        status = StatusBuffer()
+        throttle = get_throttle()
+
+        def worker():
+            try:
+                with EmailMessage.pooled_connect() as connection:
+                    while True:
+                        with lock:
+                            email = next(emails, None)
+                        if email is None:
+                            break
+
+                        # Respect the rate of the recipient's domain
+                        if self.throttled(email, throttle, verbose):
+                            status.add(email)
+                            continue
+
+                        # Send the email
+                        try:
+                            email.send(connection, debug=False, commit=False)
+                        except Exception as e:
+                            self.failed(email, e)
+                        finally:
+                            throttle.release(email.eto)
+                        status.add(email)
 
-            elif daemon:
-                # Sleep for a while
+                        if verbose:
+                            self.report(email, max_retries)
+            finally:
+                # Release the database connection of this thread
+                connections.close_all()
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(worker) for _ in range(workers)]
+                for future in futures:
+                    future.result()
+        finally:
+            # Save the remaining results
+            status.flush()
+
+    async def run_async(
+        self,
+        daemon,
+        doall,
+        bucket_size,
+        retry_all,
+        sendnow,
+        workers,
+        verbose,
+        max_retries,
+        channel,
+    ):
+        """
+        Same loop as handle() but delivering every bucket with asyncio,
+        using up to `workers` SMTP sessions at once
+        """
+
+        # One SMTP client for each concurrent session, no more than the
+        # pool allows to the threads
+        clients = [
+            EmailMessage.async_connect()
+            for _ in range(min(workers, get_pool().size))
+        ]
+        load_chunk = getattr(settings, "CLIENT_EMAIL_LOAD_CHUNK", 50)
+
+        try:
+            first = True
+            while first or daemon:
+                # Claim a bucket of emails
+                list_emails = await sync_to_async(self.claim)(
+                    doall, bucket_size, retry_all, sendnow
+                )
+
+                # Check if there are emails to process
+                if list_emails:
+
+                    # Show the number of emails to be sent in this batch
+                    if verbose:
+                        self.debug(
+                            f"Sending {len(list_emails)} emails in this "
+                            "batch",
+                            color="cyan",
+                        )
+
+                    heartbeat = LeaseHeartbeat(list_emails).start()
+                    try:
+                        # Deliver the claimed emails a chunk at a time
+                        claimed = EmailMessage.claimed(list_emails, load_chunk)
+                        while True:
+                            emails = await sync_to_async(list)(
+                                islice(claimed, load_chunk)
+                            )
+                            if not emails:
+                                break
+                            await self.send_async(
+                                emails, clients, verbose, max_retries
+                            )
+                    finally:
+                        # Give back to the queue whatever we didn't process
+                        await sync_to_async(EmailMessage.release)(list_emails)
+                        heartbeat.stop()
+
+                    # Delete all that have been sent
+                    if not getattr(settings, "CLIENT_EMAIL_HISTORY", True):
+                        await EmailMessage.objects.filter(
+                            pk__in=list_emails, sent=True
+                        ).adelete()
+
+                elif daemon:
+                    # Do not keep the sessions open while idle
+                    await self.close_async(clients)
+
+                    # Sleep until there is something to send
+                    await sync_to_async(self.wait)(channel, retry_all)
+
+                elif verbose:
+                    # No emails to send
+                    self.debug(
+                        "No emails to be sent at this moment in the queue!",
+                        color="green",
+                    )
+
+                # Refresh the metrics file
+                await sync_to_async(self.export_metrics)()
+
+                # This was the first time
+                first = False
+        finally:
+            await self.close_async(clients)
+
+    async def send_async(self, emails, clients, verbose, max_retries):
+        """
+        Deliver a bucket of emails sharing the SMTP clients, and save the
+        outcome of all of them at once
+        """
+
+        # Queue of emails to deliver
+        pending = asyncio.Queue()
+        for email in emails:
+            pending.put_nowait(email)
+
+        # Delivered emails
+        done = []
+        throttle = get_throttle()
+
+        async def worker(client):
+            while not pending.empty():
+                email = pending.get_nowait()
+
+                # Respect the rate of the recipient's domain
+                if self.throttled(email, throttle, verbose):
+                    done.append(email)
+                    continue
+
+                # Send the email
                 try:
-                    time.sleep(10)
-                except KeyboardInterrupt:
-                    self.debug("Exited by user request!", color="green")
-                    break
+                    await email.asend(client, debug=False, commit=False)
+                except Exception as e:
+                    self.failed(email, e)
+                finally:
+                    throttle.release(email.eto)
+                done.append(email)
 
-            elif verbose:
-                # No emails to send
-                self.debug(
-                    "No emails to be sent at this moment in the queue!",
-                    color="green",
-                )
+                if verbose:
+                    self.report(email, max_retries)
 
-            # This was the first time
-            first = False
+        try:
+            await asyncio.gather(
+                *[worker(client) for client in clients[: len(emails)]]
+            )
+        finally:
+            # Save all the results at once
+            if done:
+                await sync_to_async(EmailMessage.save_status)(done)
+
+    async def close_async(self, clients):
+        """
+        Disconnect the SMTP clients
+        """
+        for client in clients:
+            if client.is_connected:
+                try:
+                    await client.quit()
+                except Exception:
+                    client.close()
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+#
+# django-codenerix-email
+#
+# Codenerix GNU
+#
+# Project URL : http://www.codenerix.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger("CodenerixEmail:Metrics")
+
+# Latencies in seconds
+BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+# Every metric of this process
+registry = []
+
+
+def escape(value):
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """
+    Base of the metrics kept in this process, exported in the Prometheus
+    text format by render()
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def labelset(self, key, extra=None):
+        pairs = list(zip(self.labels, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        inner = ",".join(
+            f'{name}="{escape(value)}"' for (name, value) in pairs
+        )
+        return "{" + inner + "}"
+
+    def samples(self):
+        """
+        Yield (suffix, key, extra label, value) for every sample
+        """
+        with self._lock:
+            values = list(self._values.items())
+        for (key, value) in values:
+            yield ("", key, None, value)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {escape(self.documentation)}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for (suffix, key, extra, value) in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{self.labelset(key, extra)} "
+                f"{number(value)}"
+            )
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    """
+    Gauge set by the code, or computed when rendered if a function
+    returning {(label values): value} is given to set_function()
+    """
+
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.function = None
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                values = self.function()
+            except Exception as e:
+                logger.warning(f"Couldn't collect {self.name}: {e}")
+            else:
+                with self._lock:
+                    self._values = {
+                        tuple(str(value) for value in key): value
+                        for (key, value) in values.items()
+                    }
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # [count per bucket..., sum]
+                counts = self._values[key] = [0] * len(self.buckets) + [0]
+            for (position, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+                    break
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe how long the block takes
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [
+                (key, list(counts)) for (key, counts) in self._values.items()
+            ]
+        for (key, counts) in values:
+            total = 0
+            for (bound, count) in zip(self.buckets, counts):
+                total += count
+                yield ("_bucket", key, ("le", number(bound)), total)
+            yield ("_sum", key, None, counts[-1])
+            yield ("_count", key, None, total)
+
+
+def render():
+    """
+    All the metrics in the Prometheus text format
+    """
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        try:
+            body = render().encode("utf-8")
+        finally:
+            # Gauges may query the database from this thread
+            connections.close_all()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(port, address=None):
+    """
+    Expose the metrics at http://address:port/metrics from a background
+    thread, address is CLIENT_EMAIL_METRICS_ADDRESS (default 127.0.0.1)
+    """
+    if address is None:
+        address = getattr(
+            settings, "CLIENT_EMAIL_METRICS_ADDRESS", "127.0.0.1"
+        )
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(
+        target=server.serve_forever, name="codenerix-email-metrics"
+    )
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def write_textfile(path):
+    """
+    Write the metrics to path for the textfile collector of node_exporter,
+    the file is replaced at once so it is never read half written
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    (fd, tmp) = tempfile.mkstemp(dir=directory, prefix=".codenerix_email.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(render())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+# Sender
+QUEUE = Gauge(
+    "codenerix_email_queue_emails",
+    "Emails in the queue by state",
+    ["state"],
+)
+CLAIM_SECONDS = Histogram(
+    "codenerix_email_claim_seconds",
+    "Time spent claiming a bucket of emails",
+)
+SMTP_SECONDS = Histogram(
+    "codenerix_email_smtp_seconds",
+    "SMTP latency by stage (connect includes TLS and AUTH)",
+    ["stage"],
+)
+SENT = Counter(
+    "codenerix_email_sent_total",
+    "Emails delivered to the SMTP server",
+    ["host"],
+)
+FAILURES = Counter(
+    "codenerix_email_failures_total",
+    "Failed delivery attempts by SMTP host and kind of failure",
+    ["host", "kind"],
+)
+RETRIES = Counter(
+    "codenerix_email_retries_total",
+    "Emails scheduled to be tried again by kind of failure",
+    ["kind"],
+)
+
+# Receiver
+IMAP_SECONDS = Histogram(
+    "codenerix_email_imap_seconds",
+    "IMAP latency by operation",
+    ["operation"],
+)
+RECEIVED = Counter(
+    "codenerix_email_received_total",
+    "Received emails parsed by kind of bounce",
+    ["bounce"],
+)
+RECV_LAST_RUN = Gauge(
+    "codenerix_email_recv_last_run_timestamp_seconds",
+    "When emails_recv finished for the last time",
+)
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:14
+
+from django.db import migrations, models
+
+from codenerix_email.operations import AddIndexConcurrently
+
+# MySQL has no partial indexes, Django doesn't create the queue index there
+MYSQL_QUEUE_INDEX = models.Index(
+    fields=["sent", "sending", "error", "priority", "next_retry"],
+    name="codenerix_email_queue_my_idx",
+)
+
+
+def add_mysql_queue_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "mysql":
+        model = apps.get_model("codenerix_email", "EmailMessage")
+        schema_editor.add_index(model, MYSQL_QUEUE_INDEX)
+
+
+def remove_mysql_queue_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "mysql":
+        model = apps.get_model("codenerix_email", "EmailMessage")
+        schema_editor.remove_index(model, MYSQL_QUEUE_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    # The index is built concurrently on PostgreSQL
+    atomic = False
+
+    dependencies = [
+        ("codenerix_email", "0016_alter_emailattachment_options_and_more"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="emailmessage",
+            index=models.Index(
+                condition=models.Q(
+                    ("error", False), ("sending", False), ("sent", False)
+                ),
+                fields=["priority", "next_retry"],
+                name="codenerix_email_queue_idx",
+            ),
+        ),
+        migrations.RunPython(add_mysql_queue_index, remove_mysql_queue_index),
+    ]
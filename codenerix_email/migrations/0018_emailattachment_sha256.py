@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("codenerix_email", "0017_emailmessage_queue_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emailattachment",
+            name="sha256",
+            field=models.CharField(
+                blank=True,
+                db_index=True,
+                editable=False,
+                max_length=64,
+                null=True,
+                verbose_name="SHA-256",
+            ),
+        ),
+    ]
@@ -0,0 +1,106 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:23
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("codenerix_email", "0018_emailattachment_sha256"),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name="emailmessage",
+            old_name="log",
+            new_name="legacy_log",
+        ),
+        migrations.AlterField(
+            model_name="emailmessage",
+            name="legacy_log",
+            field=models.TextField(
+                blank=True, null=True, verbose_name="Log (before delivery attempts)"
+            ),
+        ),
+        migrations.CreateModel(
+            name="EmailDeliveryAttempt",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "created",
+                    models.DateTimeField(auto_now_add=True, verbose_name="Created"),
+                ),
+                (
+                    "updated",
+                    models.DateTimeField(auto_now=True, verbose_name="Updated"),
+                ),
+                (
+                    "date",
+                    models.DateTimeField(
+                        db_index=True,
+                        default=django.utils.timezone.now,
+                        verbose_name="Date",
+                    ),
+                ),
+                ("sent", models.BooleanField(default=False, verbose_name="Sent")),
+                (
+                    "code",
+                    models.PositiveSmallIntegerField(
+                        blank=True, null=True, verbose_name="SMTP code"
+                    ),
+                ),
+                (
+                    "exception",
+                    models.CharField(
+                        blank=True, default="", max_length=128, verbose_name="Exception"
+                    ),
+                ),
+                (
+                    "host",
+                    models.CharField(
+                        blank=True, default="", max_length=256, verbose_name="Host"
+                    ),
+                ),
+                (
+                    "duration",
+                    models.FloatField(
+                        blank=True,
+                        help_text="In seconds",
+                        null=True,
+                        verbose_name="Duration",
+                    ),
+                ),
+                ("message", models.TextField(blank=True, verbose_name="Message")),
+                (
+                    "email",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="attempts",
+                        to="codenerix_email.emailmessage",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["date", "pk"],
+                "abstract": False,
+                "default_permissions": (
+                    "add",
+                    "change",
+                    "delete",
+                    "view",
+                    "list",
+                    "detail",
+                ),
+            },
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("codenerix_email", "0019_emaildeliveryattempt"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EmailSuppression",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "created",
+                    models.DateTimeField(auto_now_add=True, verbose_name="Created"),
+                ),
+                (
+                    "updated",
+                    models.DateTimeField(auto_now=True, verbose_name="Updated"),
+                ),
+                (
+                    "email",
+                    models.EmailField(
+                        max_length=254, unique=True, verbose_name="Email"
+                    ),
+                ),
+                (
+                    "reason",
+                    models.CharField(
+                        choices=[
+                            ("B", "Bounce"),
+                            ("U", "Unsubscribe"),
+                            ("M", "Manual"),
+                        ],
+                        default="M",
+                        max_length=1,
+                        verbose_name="Reason",
+                    ),
+                ),
+                (
+                    "code",
+                    models.PositiveSmallIntegerField(
+                        blank=True, null=True, verbose_name="SMTP code"
+                    ),
+                ),
+                ("detail", models.TextField(blank=True, verbose_name="Detail")),
+            ],
+            options={
+                "abstract": False,
+                "default_permissions": (
+                    "add",
+                    "change",
+                    "delete",
+                    "view",
+                    "list",
+                    "detail",
+                ),
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:46
+
+from django.db import migrations, models
+
+from codenerix_email.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+
+    # The index is built concurrently on PostgreSQL
+    atomic = False
+
+    dependencies = [
+        ("codenerix_email", "0020_emailsuppression"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emailmessage",
+            name="lease_until",
+            field=models.DateTimeField(
+                blank=True, editable=False, null=True, verbose_name="Lease until"
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="emailmessage",
+            index=models.Index(
+                condition=models.Q(("sending", True)),
+                fields=["lease_until"],
+                name="codenerix_email_lease_idx",
+            ),
+        ),
+    ]
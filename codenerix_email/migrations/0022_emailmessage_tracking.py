@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("codenerix_email", "0021_emailmessage_lease_until"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emailmessage",
+            name="tracking",
+            field=models.BooleanField(
+                default=True,
+                help_text="Add X-Codenerix-Tracking-ID so bounces can be linked to this email, untracked emails can be sent in groups",
+                verbose_name="Tracking",
+            ),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:49
+
+from django.db import migrations, models
+
+from codenerix_email.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+
+    # The index is built concurrently on PostgreSQL
+    atomic = False
+
+    dependencies = [
+        ("codenerix_email", "0022_emailmessage_tracking"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="emailmessage",
+            index=models.Index(
+                condition=models.Q(("error", True), ("sent", False)),
+                fields=["id"],
+                name="codenerix_email_error_idx",
+            ),
+        ),
+    ]
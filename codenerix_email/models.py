@@ -19,17 +19,32 @@
 # limitations under the License.
 
 import re
+import io
+import json
 import ssl
+import base64
+import hashlib
 import smtplib
+import time
 import logging
+import threading
 from uuid import uuid4
+from itertools import islice
+from functools import lru_cache
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from email.mime.base import MIMEBase
 from typing import Optional
 
+import django
+from asgiref.sync import sync_to_async
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from django.db import models
+from django.db import models, transaction, connections, router
 from django.template import Context, Template
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ValidationError, ImproperlyConfigured
+from django.core.mail.message import sanitize_address
+from django.core.files import File
 from django.conf import settings
 from django.db.models import Q
 from django.utils.safestring import SafeString
@@ -42,6 +57,23 @@ from codenerix.lib.genmail import (  # noqa: N817
 )
 from codenerix.fields import WysiwygAngularField
 
+from codenerix_email.smtp import PersistentConnection, get_pool, open_backend
+from codenerix_email.timing import NULL_TIMING, get_timer
+from codenerix_email.wakeup import get_channel
+from codenerix_email.throttle import get_throttle, interleave
+from codenerix_email.retry import (
+    classify,
+    get_retry_policy,
+    refused,
+    smtp_code,
+)
+from codenerix_email import cache, metrics
+
+try:
+    import aiosmtplib
+except ImportError:  # pragma: no cover
+    aiosmtplib = None
+
 CONTENT_SUBTYPE_PLAIN = "plain"
 CONTENT_SUBTYPE_HTML = "html"
 CONTENT_SUBTYPES = (
@@ -56,9 +88,121 @@ BOUNCE_TYPES = (
     (BOUNCE_HARD, _("Hard")),
 )
 
+SUPPRESSION_BOUNCE = "B"
+SUPPRESSION_UNSUBSCRIBE = "U"
+SUPPRESSION_MANUAL = "M"
+SUPPRESSION_REASONS = (
+    (SUPPRESSION_BOUNCE, _("Bounce")),
+    (SUPPRESSION_UNSUBSCRIBE, _("Unsubscribe")),
+    (SUPPRESSION_MANUAL, _("Manual")),
+)
+
+# Fields changed by EmailMessage.send()
+STATUS_FIELDS = [
+    "sending",
+    "sent",
+    "error",
+    "priority",
+    "retries",
+    "next_retry",
+    "updated",
+]
+
 logger = logging.getLogger("CodenerixEmail:EmailMessage")
 
 
+class StatusBuffer:
+    """
+    Collect the emails sent with commit=False and save their status with
+    EmailMessage.save_status() every CLIENT_EMAIL_STATUS_FLUSH_SIZE emails
+    or CLIENT_EMAIL_STATUS_FLUSH_INTERVAL milliseconds, remember to flush()
+    at the end
+    """
+
+    def __init__(self, size=None, interval=None):
+        self.lock = threading.Lock()
+        if size is None:
+            size = getattr(settings, "CLIENT_EMAIL_STATUS_FLUSH_SIZE", 100)
+        if interval is None:
+            interval = getattr(
+                settings, "CLIENT_EMAIL_STATUS_FLUSH_INTERVAL", 1000
+            )
+        self.size = size
+        self.interval = interval / 1000
+        self.emails = []
+        self.last_flush = time.monotonic()
+
+    def add(self, email):
+        with self.lock:
+            self.emails.append(email)
+            full = (
+                len(self.emails) >= self.size
+                or time.monotonic() - self.last_flush >= self.interval
+            )
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            (emails, self.emails) = (self.emails, [])
+            self.last_flush = time.monotonic()
+        if emails:
+            EmailMessage.save_status(emails)
+
+
+class LeaseHeartbeat:
+    """
+    Renew the lease of a bucket claimed with EmailMessage.claim() every
+    third of CLIENT_EMAIL_LEASE from a background thread while it is being
+    delivered, however long each email takes:
+
+        with LeaseHeartbeat(pks):
+            deliver the bucket
+
+    or call start() and stop().
+    """
+
+    def __init__(self, pks, lease=None):
+        if lease is None:
+            lease = getattr(settings, "CLIENT_EMAIL_LEASE", 600)
+        self.pks = pks
+        self.interval = lease / 3
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                try:
+                    EmailMessage.renew(self.pks)
+                except Exception as e:
+                    logger.warning(f"Couldn't renew the lease: {e}")
+        finally:
+            # Release the database connection of this thread
+            connections.close_all()
+
+    def start(self):
+        if self.interval and self.pks:
+            self.thread = threading.Thread(
+                target=self.run, name="codenerix-email-lease", daemon=True
+            )
+            self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
 def ensure_header(headers, key, value, headers_keys=None):
     if headers_keys is None:
         headers_keys = [k.lower() for k in headers.keys()]
@@ -98,7 +242,12 @@ class EmailMessage(CodenerixModel):
         _("Retries"), blank=False, null=False, default=0
     )
     next_retry = models.DateTimeField(_("Next retry"), auto_now_add=True)
-    log = models.TextField(_("Log"), blank=True, null=True)
+    lease_until = models.DateTimeField(
+        _("Lease until"), blank=True, null=True, editable=False
+    )
+    legacy_log = models.TextField(
+        _("Log (before delivery attempts)"), blank=True, null=True
+    )
     opened = models.DateTimeField(
         _("Opened"), null=True, blank=True, default=None
     )
@@ -114,6 +263,16 @@ class EmailMessage(CodenerixModel):
         _("Unsubscribe URL"), blank=True, null=True
     )
     headers = models.JSONField(_("Headers"), blank=True, null=True)
+    tracking = models.BooleanField(
+        _("Tracking"),
+        blank=False,
+        null=False,
+        default=True,
+        help_text=_(
+            "Add X-Codenerix-Tracking-ID so bounces can be linked to this "
+            "email, untracked emails can be sent in groups"
+        ),
+    )
     bounces_soft = models.PositiveIntegerField(
         _("Soft bounces"), blank=False, null=False, default=0
     )
@@ -124,6 +283,31 @@ class EmailMessage(CodenerixModel):
         _("Total bounces"), blank=False, null=False, default=0
     )
 
+    class Meta(CodenerixModel.Meta):
+        indexes = [
+            # Pending queue, see EmailMessage.pending(). Only pending emails
+            # are indexed, Django skips partial indexes where they aren't
+            # supported so MySQL gets a full composite index from migration
+            # 0017 instead
+            models.Index(
+                fields=["priority", "next_retry"],
+                name="codenerix_email_queue_idx",
+                condition=Q(sent=False, sending=False, error=False),
+            ),
+            # Claims to expire, see EmailMessage.expire_leases()
+            models.Index(
+                fields=["lease_until"],
+                name="codenerix_email_lease_idx",
+                condition=Q(sending=True),
+            ),
+            # Failed emails, see EmailMessage.queue_depth()
+            models.Index(
+                fields=["id"],
+                name="codenerix_email_error_idx",
+                condition=Q(error=True, sent=False),
+            ),
+        ]
+
     def recalculate_bounces(self):
         bounces_soft = self.receiveds.filter(bounce_type=BOUNCE_SOFT).count()
         bounces_hard = self.receiveds.filter(bounce_type=BOUNCE_HARD).count()
@@ -255,7 +439,10 @@ class EmailMessage(CodenerixModel):
             )
 
         # Prepare message Tracking info
-        if "X-Codenerix-Tracking-ID".lower() not in headers_keys:
+        if (
+            self.tracking
+            and "X-Codenerix-Tracking-ID".lower() not in headers_keys
+        ):
             ets = int(timezone.now().timestamp())
             ensure_header(
                 headers,
@@ -286,6 +473,467 @@ class EmailMessage(CodenerixModel):
         # Return headers
         return headers
 
+    @classmethod
+    def pending(cls, retry_all=False, sendnow=False):
+        """
+        Return the queryset of emails waiting in the queue, in the order
+        they should be sent
+        """
+
+        # Emails that are not being sent by anybody right now
+        emails = cls.objects.filter(sent=False, sending=False, error=False)
+
+        # If we do not have to retry all we have to check the retries
+        if not retry_all:
+            emails = emails.filter(
+                retries__lt=getattr(settings, "CLIENT_EMAIL_RETRIES", 10)
+            )
+
+        # If we do not have to send now we have to wait for the next retry
+        if not sendnow:
+            emails = emails.filter(next_retry__lte=timezone.now())
+
+        # Order emails by priority and next retry
+        return emails.order_by("priority", "next_retry")
+
+    @classmethod
+    def next_due(cls, retry_all=False):
+        """
+        Return how many seconds are left until the next email in the queue
+        has to be sent (None if the queue is empty)
+        """
+        emails = cls.objects.filter(sent=False, sending=False, error=False)
+        if not retry_all:
+            emails = emails.filter(
+                retries__lt=getattr(settings, "CLIENT_EMAIL_RETRIES", 10)
+            )
+        next_retry = (
+            emails.order_by("next_retry")
+            .values_list("next_retry", flat=True)
+            .first()
+        )
+        if next_retry is None:
+            return None
+        return max(0, (next_retry - timezone.now()).total_seconds())
+
+    @classmethod
+    def claim(cls, limit=None, retry_all=False, sendnow=False):
+        """
+        Atomically take a bucket of emails from the queue and set them as
+        sending, so several workers (even on different hosts) can drain the
+        same queue without sending any email twice. The claim is a lease of
+        CLIENT_EMAIL_LEASE seconds (renewed by LeaseHeartbeat while the
+        bucket is delivered), if the worker dies its emails go back to the
+        queue when it expires.
+
+        Returns the list of claimed primary keys in sending order, when
+        CLIENT_EMAIL_DOMAIN_RATES is set the recipient domains are
+        interleaved.
+        """
+
+        # Give back the emails of workers that died
+        cls.expire_leases()
+
+        # Get the bucket we would like to take
+        emails = cls.pending(retry_all=retry_all, sendnow=sendnow)
+        if limit is not None:
+            emails = emails[:limit]
+        lease_until = cls.lease_until_from_now()
+
+        db = router.db_for_write(cls)
+        if connections[db].features.has_select_for_update_skip_locked:
+            # Lock the rows, skipping those already locked by other workers
+            with transaction.atomic(using=db):
+                rows = list(
+                    emails.select_for_update(skip_locked=True).values_list(
+                        "pk", "eto"
+                    )
+                )
+                if rows:
+                    cls.objects.filter(pk__in=[r[0] for r in rows]).update(
+                        sending=True, lease_until=lease_until
+                    )
+        else:
+            # No row locking available (SQLite), compare-and-swap every row
+            # so only one worker can switch it from pending to sending
+            rows = []
+            still_pending = cls.pending(retry_all=retry_all, sendnow=sendnow)
+            for pk, eto in emails.values_list("pk", "eto"):
+                if still_pending.filter(pk=pk).update(
+                    sending=True, lease_until=lease_until
+                ):
+                    rows.append((pk, eto))
+
+        # Never spend an SMTP transaction on suppressed addresses
+        if rows and getattr(settings, "CLIENT_EMAIL_SUPPRESSION", False):
+            rows = cls.drop_suppressed(rows)
+
+        # Do not send in a row to the same domain
+        if get_throttle().enabled:
+            rows = interleave(rows)
+
+        return [pk for (pk, _) in rows]
+
+    @classmethod
+    def lease_until_from_now(cls):
+        """
+        When a claim made now expires, None if CLIENT_EMAIL_LEASE is 0
+        """
+        lease = getattr(settings, "CLIENT_EMAIL_LEASE", 600)
+        if not lease:
+            return None
+        return timezone.now() + timezone.timedelta(seconds=lease)
+
+    @classmethod
+    def renew(cls, pks):
+        """
+        Extend the lease of the claimed emails still being sent
+        """
+        return cls.objects.filter(pk__in=pks, sending=True).update(
+            lease_until=cls.lease_until_from_now()
+        )
+
+    @classmethod
+    def expire_leases(cls):
+        """
+        Give back to the queue the claimed emails whose lease expired (their
+        worker died while sending them)
+        """
+        return cls.objects.filter(
+            sending=True, lease_until__lt=timezone.now()
+        ).update(sending=False, lease_until=None)
+
+    @classmethod
+    def drop_suppressed(cls, rows):
+        """
+        Set as error the claimed (pk, eto) rows whose address is suppressed,
+        returns the remaining rows
+        """
+        suppressed = EmailSuppression.suppressed_among([r[1] for r in rows])
+        if not suppressed:
+            return rows
+
+        dropped = [r for r in rows if r[1].strip().lower() in suppressed]
+        cls.objects.filter(pk__in=[r[0] for r in dropped]).update(
+            sending=False, error=True, updated=timezone.now()
+        )
+        EmailDeliveryAttempt.objects.bulk_create(
+            [
+                EmailDeliveryAttempt(email_id=pk, message=f"{eto}: Suppressed")
+                for (pk, eto) in dropped
+            ]
+        )
+        return [r for r in rows if r[1].strip().lower() not in suppressed]
+
+    @classmethod
+    def claimed(cls, pks, chunk_size=None):
+        """
+        Iterate over a bucket of claimed emails ready to be sent (pks in the
+        order given by claim()). Emails are loaded with their attachments in
+        chunks of CLIENT_EMAIL_LOAD_CHUNK, so only a few bodies are in
+        memory at once however big the bucket is. Keep the lease of the
+        bucket with LeaseHeartbeat while iterating.
+        """
+        if chunk_size is None:
+            chunk_size = getattr(settings, "CLIENT_EMAIL_LOAD_CHUNK", 50)
+        for start in range(0, len(pks), chunk_size):
+            chunk = pks[start : start + chunk_size]
+            emails = cls.objects.filter(pk__in=chunk).prefetch_related(
+                "attachments"
+            )
+            order = {pk: position for (position, pk) in enumerate(chunk)}
+            for email in sorted(emails, key=lambda email: order[email.pk]):
+                # The suppression list was checked by claim()
+                email.suppression_checked = True
+                yield email
+
+    @classmethod
+    def grouped(cls, emails, size=None, chunk_size=None):
+        """
+        Iterate over lists of emails with the same content (see
+        payload_key()) of up to size (CLIENT_EMAIL_GROUP_SIZE) recipients,
+        looking for them CLIENT_EMAIL_LOAD_CHUNK emails at a time
+        """
+        if size is None:
+            size = getattr(settings, "CLIENT_EMAIL_GROUP_SIZE", 50)
+        if chunk_size is None:
+            chunk_size = getattr(settings, "CLIENT_EMAIL_LOAD_CHUNK", 50)
+        emails = iter(emails)
+        while True:
+            chunk = list(islice(emails, chunk_size))
+            if not chunk:
+                break
+            groups = {}
+            for email in chunk:
+                key = email.payload_key()
+                if key is None:
+                    yield [email]
+                    continue
+                group = groups.setdefault(key, [])
+                group.append(email)
+                if len(group) >= size:
+                    yield groups.pop(key)
+            yield from groups.values()
+
+    @classmethod
+    def release(cls, pks):
+        """
+        Give back to the queue those claimed emails that are still set as
+        sending (they were not processed)
+        """
+        return cls.objects.filter(pk__in=pks, sending=True).update(
+            sending=False, lease_until=None
+        )
+
+    @classmethod
+    def queue_depth(cls, sent=False):
+        """
+        Number of emails in the queue by state (pending, sending and error),
+        every state is counted through its partial index. The sent emails
+        are the whole history of the table, they are only counted if sent
+        is True
+        """
+        emails = cls.objects.order_by()
+        depth = {
+            "pending": emails.filter(
+                sent=False, sending=False, error=False
+            ).count(),
+            "sending": emails.filter(sending=True).count(),
+            "error": emails.filter(error=True, sent=False).count(),
+        }
+        if sent:
+            depth["sent"] = emails.filter(sent=True).count()
+        return depth
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._status = instance.status()
+        return instance
+
+    def status(self):
+        """
+        Current value of the loaded status fields (see STATUS_FIELDS)
+        """
+        return {
+            field: self.__dict__[field]
+            for field in STATUS_FIELDS
+            if field in self.__dict__
+        }
+
+    def changed_status(self):
+        """
+        List of status fields changed since this email was loaded or saved
+        """
+        loaded = getattr(self, "_status", {})
+        missing = object()
+        return [
+            field
+            for (field, value) in self.status().items()
+            if field != "updated" and loaded.get(field, missing) != value
+        ]
+
+    def remember_status(self, fields=None):
+        """
+        Take the current value of the status fields (only those in fields if
+        given) as the ones stored in the database
+        """
+        status = self.status()
+        if fields is not None:
+            status = {
+                field: value
+                for (field, value) in status.items()
+                if field in fields
+            }
+        self._status = {**getattr(self, "_status", {}), **status}
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.remember_status(kwargs.get("update_fields"))
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        self.remember_status(fields)
+
+    @classmethod
+    def save_status(cls, emails):
+        """
+        Save in one go the sending status of several emails sent with
+        commit=False, only the status fields changed in each email are
+        written (never the body). Their send timing is reported here, with
+        the time spent saving spread over them.
+        """
+        started = time.perf_counter()
+        now = timezone.now()
+        groups = {}
+        attempts = []
+        for email in emails:
+            if email.pk is None:
+                # Never saved before
+                email.save()
+            else:
+                fields = email.changed_status()
+                if fields:
+                    email.updated = now
+                    groups.setdefault(
+                        tuple(fields) + ("updated",), []
+                    ).append(email)
+            attempts.extend(email.new_attempts)
+            email.new_attempts.clear()
+
+        # Update together the emails with the same changes
+        for fields, group in groups.items():
+            cls.objects.bulk_update(group, fields)
+            for email in group:
+                email.remember_status()
+
+        # Delivery attempts are only inserted
+        for attempt in attempts:
+            attempt.email_id = attempt.email.pk
+        EmailDeliveryAttempt.objects.bulk_create(attempts)
+
+        # Report the emails sent with commit=False, with their share of the
+        # time spent saving (see end_timing())
+        share = (time.perf_counter() - started) / max(len(emails), 1)
+        for email in emails:
+            timing = getattr(email, "timing", None)
+            if timing is not None:
+                email.timing = None
+                timing.add("save", share)
+                timing.end(sent=email.sent, error=email.error)
+
+    @classmethod
+    def enqueue_many(
+        cls,
+        template,
+        recipients,
+        lang=None,
+        attachments=None,
+        priority=5,
+        chunk_size=None,
+        processes=None,
+    ):
+        """
+        Queue one email for each recipient rendering an EmailTemplate (or
+        its CID), rows are inserted in chunks of CLIENT_EMAIL_ENQUEUE_CHUNK
+        emails with bulk_create().
+
+        Usage:
+            EmailMessage.enqueue_many(
+                "NEWSLETTER",
+                ((eto, context) for (eto, context) in ...),
+                attachments=[("offer.pdf", "application/pdf", path)],
+            )
+
+        > recipients: (eto, context) or (eto, context, fields) tuples, where
+          fields is a dictionary of extra attributes for that email (like
+          unsubscribe_url or headers)
+        > attachments: (filename, mime, path) tuples shared by all the
+          emails, path is either the name of a file in the storage or a
+          File which will be stored just once
+        > processes: render using a pool of processes (see render_many())
+
+        Recipients in the suppression list are skipped when
+        CLIENT_EMAIL_SUPPRESSION is set.
+
+        Returns the number of queued emails.
+        """
+        if chunk_size is None:
+            chunk_size = getattr(settings, "CLIENT_EMAIL_ENQUEUE_CHUNK", 500)
+
+        # Get the template
+        if not isinstance(template, EmailTemplate):
+            template = EmailTemplate.objects.get(cid=template)
+
+        # Store the attachments once, all emails will point to the same file
+        shared = []
+        for filename, mime, path in attachments or []:
+            if isinstance(path, File):
+                (path, sha256) = EmailAttachment.store(path, filename)
+            else:
+                sha256 = EmailAttachment.digest_of(path)
+            shared.append((filename, mime, path, sha256))
+
+        db = router.db_for_write(cls)
+        can_return = connections[db].features.can_return_rows_from_bulk_insert
+        # Render the emails as they are needed
+        waiting = deque()
+
+        def allowed():
+            recipients_iter = iter(recipients)
+            if not getattr(settings, "CLIENT_EMAIL_SUPPRESSION", False):
+                yield from recipients_iter
+                return
+            # Check the suppression list a chunk at a time
+            while True:
+                chunk = list(islice(recipients_iter, chunk_size))
+                if not chunk:
+                    break
+                suppressed = EmailSuppression.suppressed_among(
+                    [r[0] for r in chunk]
+                )
+                for recipient in chunk:
+                    if recipient[0].strip().lower() not in suppressed:
+                        yield recipient
+
+        def contexts():
+            for recipient in allowed():
+                waiting.append(recipient)
+                yield dict(recipient[1])
+
+        def rendered():
+            for email in template.render_many(contexts(), lang, processes):
+                recipient = waiting.popleft()
+                email.eto = recipient[0]
+                email.priority = priority
+                if len(recipient) > 2:
+                    for key, value in recipient[2].items():
+                        setattr(email, key, value)
+                yield email
+
+        rendered_emails = rendered()
+        total = 0
+        while True:
+            emails = list(islice(rendered_emails, chunk_size))
+            if not emails:
+                break
+
+            with transaction.atomic(using=db):
+                cls.objects.bulk_create(emails)
+
+                if shared:
+                    # Get the primary keys if the backend didn't return them
+                    if not can_return:
+                        pks = dict(
+                            cls.objects.filter(
+                                uuid__in=[e.uuid for e in emails]
+                            ).values_list("uuid", "pk")
+                        )
+                        for email in emails:
+                            email.pk = pks[email.uuid]
+
+                    # Attach the shared files
+                    EmailAttachment.objects.bulk_create(
+                        [
+                            EmailAttachment(
+                                email_id=email.pk,
+                                filename=filename,
+                                mime=mime,
+                                path=path,
+                                sha256=sha256,
+                            )
+                            for email in emails
+                            for (filename, mime, path, sha256) in shared
+                        ]
+                    )
+
+                # Wake up the daemon (bulk_create() sends no signals)
+                transaction.on_commit(get_channel().notify, using=db)
+
+            total += len(emails)
+
+        return total
+
     @classmethod
     def process_queue(
         cls, connection=None, legacy=False, silent=True, debug=False
@@ -294,46 +942,87 @@ class EmailMessage(CodenerixModel):
         This method will process all the emails in the queue
         """
 
-        # Process queue
-        emails = cls.objects.filter(
-            sent=False, error=False, next_retry__lte=timezone.now()
-        )
+        # Claim the queue
+        pks = cls.claim()
 
         # Do we have to send emails
-        if emails.count():
+        if pks:
             # Get connection if not connected yet
             if connection is None:
                 # Connect
-                connection = cls.internal_connect(legacy)
-
-            # Configure them as sending
-            emails.update(sending=True)
+                (connection, _) = cls.internal_connect(legacy)
 
             # Send them
-            for email in emails.order_by("priority"):
-                try:
-                    email.send(
-                        connection=connection,
-                        legacy=legacy,
-                        silent=silent,
-                        debug=debug,
-                    )
-                except Exception as e:
-                    # Los the error into this email
-                    if email.log is None:
-                        email.log = ""
-                    email.log += f"Error: {e}\n"
-                    email.sending = False
-                    email.save()
-                    email.warning(f"Error at EmailMessage<{{email.pk}}>: {e}")
-
-                    # Set all emails to not sending, since we are stopping now
-                    emails.update(sending=False)
-
-                    # Re-raise the exception
-                    raise
+            emails = cls.claimed(pks)
+            status = StatusBuffer()
+            throttle = get_throttle()
+            try:
+                for email in emails:
+                    # Respect the rate of the recipient's domain
+                    delay = throttle.acquire(email.eto)
+                    if delay:
+                        email.defer(delay)
+                        status.add(email)
+                        continue
+
+                    try:
+                        email.send(
+                            connection=connection,
+                            legacy=legacy,
+                            silent=silent,
+                            debug=debug,
+                            commit=False,
+                        )
+                        status.add(email)
+                    except Exception as e:
+                        # Los the error into this email
+                        email.add_attempt(f"Error: {e}", e)
+                        email.sending = False
+                        status.add(email)
+                        logger.warning(
+                            f"Error at EmailMessage<{email.pk}>: {e}"
+                        )
+
+                        # Re-raise the exception
+                        raise
+                    finally:
+                        throttle.release(email.eto)
+            finally:
+                # Save what we did and set all emails to not sending, since
+                # we are done
+                status.flush()
+                cls.release(pks)
 
-                emails.update(sending=False)
+    @classmethod
+    def connection_settings(cls, legacy=False):
+        """
+        Return the (host, port, username, password, use_tls) tuple to use
+        when connecting
+        """
+        if not legacy:
+            return (
+                settings.CLIENT_EMAIL_HOST,
+                settings.CLIENT_EMAIL_PORT,
+                settings.CLIENT_EMAIL_USERNAME,
+                settings.CLIENT_EMAIL_PASSWORD,
+                settings.CLIENT_EMAIL_USE_TLS,
+            )
+        else:
+            return (
+                settings.EMAIL_HOST,
+                settings.EMAIL_PORT,
+                settings.EMAIL_USERNAME,
+                settings.EMAIL_PASSWORD,
+                settings.EMAIL_USE_TLS,
+            )
+
+    @classmethod
+    def connection_key(cls, legacy=False):
+        """
+        Return the key identifying the SMTP account used to connect
+        """
+        (host, port, username, _, use_tls) = cls.connection_settings(legacy)
+        return (host, port, username, use_tls, legacy)
 
     @classmethod
     def internal_connect(cls, legacy=False):
@@ -342,51 +1031,348 @@ class EmailMessage(CodenerixModel):
         with connection.close()
         """
 
-        if not legacy:
-            host = settings.CLIENT_EMAIL_HOST
-            port = settings.CLIENT_EMAIL_PORT
-            username = settings.CLIENT_EMAIL_USERNAME
-            password = settings.CLIENT_EMAIL_PASSWORD
-            use_tls = settings.CLIENT_EMAIL_USE_TLS
-        else:
-            host = settings.EMAIL_HOST
-            port = settings.EMAIL_PORT
-            username = settings.EMAIL_USERNAME
-            password = settings.EMAIL_PASSWORD
-            use_tls = settings.EMAIL_USE_TLS
+        (host, port, username, password, use_tls) = cls.connection_settings(
+            legacy
+        )
 
         # Remember last connection data
         connect_info = {
             "host": host,
             "port": port,
+            "username": username,
             "use_tls": use_tls,
             "legacy": legacy,
         }
         # Get connection
-        return (
-            get_connection(
-                host=host,
-                port=port,
-                username=username,
-                password=password,
-                use_tls=use_tls,
-            ),
-            connect_info,
+        connection = get_connection(
+            host=host,
+            port=port,
+            username=username,
+            password=password,
+            use_tls=use_tls,
+        )
+        connection.connect_info = connect_info
+        return (connection, connect_info)
+
+    @classmethod
+    def persistent_connect(cls, legacy=False):
+        """
+        This class will return a connection instance that keeps the SMTP
+        session open between messages, you can disconnect it with
+        connection.close()
+        """
+        (connection, connect_info) = cls.internal_connect(legacy)
+        return PersistentConnection(connection, connect_info)
+
+    @classmethod
+    def pooled_connect(cls, legacy=False):
+        """
+        Check out a persistent connection from the shared pool, use it as a
+        context manager:
+
+            with EmailMessage.pooled_connect() as connection:
+                email.send(connection)
+        """
+        return get_pool().connection(
+            cls.connection_key(legacy), lambda: cls.persistent_connect(legacy)
+        )
+
+    @classmethod
+    def async_connect(cls, legacy=False):
+        """
+        This class will return a new aiosmtplib client for asend(), connect
+        it with "await connection.connect()" and disconnect it with
+        "await connection.quit()"
+        """
+        if aiosmtplib is None:
+            raise ImproperlyConfigured(
+                "aiosmtplib is required to send emails asynchronously, "
+                "install django-codenerix-email[async]"
+            )
+
+        (host, port, username, password, use_tls) = cls.connection_settings(
+            legacy
+        )
+        if not legacy:
+            use_ssl = getattr(settings, "CLIENT_EMAIL_USE_SSL", False)
+        else:
+            use_ssl = getattr(settings, "EMAIL_USE_SSL", False)
+
+        connection = aiosmtplib.SMTP(
+            hostname=host,
+            port=port,
+            username=username or None,
+            password=password or None,
+            use_tls=use_ssl,
+            start_tls=use_tls,
+            timeout=getattr(settings, "CLIENT_EMAIL_TIMEOUT", 10),
         )
 
+        # Remember connection data
+        connection.connect_info = {
+            "host": host,
+            "port": port,
+            "username": username,
+            "use_tls": use_tls,
+            "legacy": legacy,
+        }
+        return connection
+
     def connect(self, legacy=False):
         (connection, self.__connect_info) = EmailMessage.internal_connect(
             legacy
         )
         return connection
 
+    @property
+    def new_attempts(self):
+        """
+        Delivery attempts not saved yet (see save_status())
+        """
+        return self.__dict__.setdefault("_new_attempts", [])
+
+    @property
+    def log(self):
+        """
+        Log of this email, built from its failed delivery attempts
+        """
+        lines = [self.legacy_log] if self.legacy_log else []
+        attempts = list(self.attempts.all()) if self.pk else []
+        for attempt in attempts + self.new_attempts:
+            if not attempt.sent:
+                lines.append(f"{attempt.message}\n")
+        return "".join(lines) or None
+
+    def add_attempt(
+        self, error=None, exception=None, connection=None, started=None
+    ):
+        """
+        Record a delivery attempt of this email, error is None when the
+        email was delivered
+        """
+        ci = getattr(connection, "connect_info", None) or {}
+        host = ci.get("host") or ""
+        duration = time.monotonic() - started if started is not None else None
+        self.new_attempts.append(
+            EmailDeliveryAttempt(
+                email=self,
+                sent=error is None,
+                code=smtp_code(exception),
+                exception=type(exception).__name__ if exception else "",
+                host=host,
+                duration=duration,
+                message=(error or "").strip(),
+            )
+        )
+        if error is None:
+            metrics.SENT.inc(host=host)
+            if duration is not None:
+                metrics.SMTP_SECONDS.observe(duration, stage="send")
+        else:
+            metrics.FAILURES.inc(host=host, kind=classify(exception))
+
+    def retry_later(self, exception=None):
+        """
+        Schedule a new try for this email after a failed one, when is
+        decided by the retry policy (see codenerix_email.retry)
+        """
+        policy = get_retry_policy()
+        # We will not retry anymore (for now)
+        self.sending = False
+        if policy.give_up(self, exception):
+            # It will never work (like "550 user unknown")
+            self.retries += 1
+            self.error = True
+            return
+        (wait, demote) = policy.schedule(self, exception)
+        # We make lower this email's priority
+        if demote:
+            self.priority += 1
+        # Set we just made a new retry
+        self.retries += 1
+        self.next_retry = timezone.now() + timezone.timedelta(seconds=wait)
+        if self.retries >= getattr(
+            settings, "CLIENT_EMAIL_RETRIES", 10
+        ):  # How long it took depends on the policy (14.5h for connections)
+            self.error = True
+        else:
+            metrics.RETRIES.inc(kind=classify(exception))
+
+    def suppressed(self):
+        """
+        Tell if the recipient is in the suppression list (only when
+        CLIENT_EMAIL_SUPPRESSION is set)
+        """
+        if getattr(self, "suppression_checked", False):
+            return False
+        return getattr(
+            settings, "CLIENT_EMAIL_SUPPRESSION", False
+        ) and EmailSuppression.is_suppressed(self.eto)
+
+    def suppress_refused(self, exception):
+        """
+        Add the recipient to the suppression list if the server refused it
+        permanently (only when CLIENT_EMAIL_SUPPRESSION is set)
+        """
+        if getattr(settings, "CLIENT_EMAIL_SUPPRESSION", False) and refused(
+            exception
+        ):
+            EmailSuppression.suppress(
+                self.eto,
+                SUPPRESSION_BOUNCE,
+                smtp_code(exception),
+                str(exception),
+            )
+
+    def drop(self, error):
+        """
+        Give up on this email without trying to deliver it
+        """
+        self.sending = False
+        self.error = True
+        self.add_attempt(error)
+
+    def defer(self, seconds):
+        """
+        Put this email back in the queue for seconds, it doesn't count as a
+        retry (used when its domain is throttled)
+        """
+        self.sending = False
+        self.next_retry = timezone.now() + timezone.timedelta(seconds=seconds)
+
+    def connect_error(self, e, connect_info=None):
+        """
+        Build the log line for an error while connecting
+        """
+        ci = connect_info or getattr(self, "_EmailMessage__connect_info", {})
+        return "{}-> {}: {} [HOST={}:{} TLS={}]\n".format(
+            self.eto,
+            type(e).__name__,
+            e,
+            ci.get("host", "-"),
+            ci.get("port", "-"),
+            ci.get("use_tls", "-"),
+        )
+
+    def build_message(self, legacy=False, connection=None, timing=None):
+        """
+        Build the message to be delivered for this email, timing gets how
+        long each step takes (see codenerix_email.timing)
+        """
+        timing = timing or NULL_TIMING
+        with timing.stage("headers"):
+            headers = self.get_headers(legacy)
+        with timing.stage("mime"):
+            email = EM(
+                subject=self.subject,
+                body=self.body,
+                from_email=self.efrom,
+                to=[self.eto],
+                connection=connection,
+                headers=headers,
+            )
+            email.content_subtype = self.content_subtype
+        with timing.stage("attachments"):
+            for at in self.attachments.all():
+                email.attach(at.mime_part())
+        return email
+
+    def payload_key(self):
+        """
+        Key shared by the emails with the same content, which can go in the
+        same transaction with send_group(), None if this one can't
+        """
+        if not self.eto or self.tracking or self.unsubscribe_url:
+            # The tracking ID and List-Unsubscribe are different for every
+            # recipient
+            return None
+        return (
+            self.efrom,
+            self.subject,
+            self.body,
+            self.content_subtype,
+            json.dumps(self.headers or {}, sort_keys=True),
+            tuple(
+                sorted(
+                    (at.filename, at.mime, at.sha256 or at.path.name)
+                    for at in self.attachments.all()
+                )
+            ),
+        )
+
+    @classmethod
+    def send_group(cls, emails, connection, legacy=False):
+        """
+        Deliver emails with the same content (see payload_key()) in a single
+        SMTP transaction, only emails without tracking can be grouped. The
+        message goes to all of them as undisclosed recipients. Every email
+        records its own outcome, save them with save_status().
+        """
+        message = emails[0].build_message(legacy, connection)
+        message.extra_headers["To"] = "undisclosed-recipients:;"
+        encoding = message.encoding or settings.DEFAULT_CHARSET
+        from_email = sanitize_address(message.from_email, encoding)
+        recipients = {
+            sanitize_address(email.eto, encoding): email for email in emails
+        }
+        data = message.message().as_bytes(linesep="\r\n")
+
+        started = time.monotonic()
+        try:
+            if connection.open():
+                metrics.SMTP_SECONDS.observe(
+                    time.monotonic() - started, stage="connect"
+                )
+                started = time.monotonic()
+            if getattr(connection, "persistent", False):
+                refused = connection.sendmail(
+                    from_email, list(recipients), data
+                )
+            else:
+                refused = connection.connection.sendmail(
+                    from_email, list(recipients), data
+                )
+        except smtplib.SMTPRecipientsRefused as e:
+            # Nobody was accepted
+            refused = e.recipients
+        except (smtplib.SMTPException, OSError) as e:
+            # The transaction failed for all of them
+            for email in emails:
+                error = f"{email.eto}: {type(e).__name__}: {e}\n"
+                email.add_attempt(error, e, connection, started)
+                email.retry_later(e)
+            if getattr(connection, "persistent", False):
+                connection.close()
+            return
+        finally:
+            if not getattr(connection, "persistent", False):
+                connection.close()
+
+        for address, email in recipients.items():
+            if address in refused:
+                e = smtplib.SMTPRecipientsRefused({address: refused[address]})
+                error = f"{email.eto}: SMTPRecipientsRefused: {e}\n"
+                email.add_attempt(error, e, connection, started)
+                email.retry_later(e)
+                email.suppress_refused(e)
+            else:
+                email.sent = True
+                email.sending = False
+                email.add_attempt(connection=connection, started=started)
+
     def send(
         self,
         connection=None,
         legacy=False,
         silent=True,
         debug=False,
+        commit=True,
     ):
+        """
+        Send this email, with commit=False the outcome is left in the
+        instance and the caller is in charge of saving it (see save_status())
+        """
+
         # Get connection if not connected yet
         if connection is None:
             # Connect
@@ -394,95 +1380,89 @@ class EmailMessage(CodenerixModel):
                 logger.warning("Not connected, connecting...")
             connection = self.connect(legacy)
 
+        # Never send to suppressed addresses
+        if self.eto and not self.error and not self.sent and self.suppressed():
+            self.drop(f"{self.eto}: Suppressed")
+            if commit:
+                EmailMessage.save_status([self])
+            return
+
         # Guards, nobody should try to send in this conditions
         # 1: No destination
         # 2: Already sent
         # 3: Already in fatal error
         if self.eto and not self.error and not self.sent:
+            # Measure the stages if requested (see codenerix_email.timing)
+            timing = get_timer().begin(self)
+
             # Manually open the connection
             error = None
+            started = time.monotonic()
             try:
-                connection.open()
+                if getattr(connection, "persistent", False):
+                    opened = connection.open(timing)
+                else:
+                    opened = open_backend(connection, timing)
+                if opened:
+                    metrics.SMTP_SECONDS.observe(
+                        time.monotonic() - started, stage="connect"
+                    )
             except (
                 smtplib.SMTPAuthenticationError,
                 OSError,
                 TimeoutError,
             ) as e:
-                connection = None
-                exceptiontxt = str(type(e)).split(".")[-1].split("'")[0]
-                ci = getattr(self, "__connect_info", {})
-                error = "{}-> {}: {} [HOST={}:{} TLS={}]\n".format(
-                    self.eto,
-                    exceptiontxt,
-                    e,
-                    ci.get("host", "-"),
-                    ci.get("port", "-"),
-                    ci.get("use_tls", "-"),
+                error = self.connect_error(
+                    e, getattr(connection, "connect_info", None)
                 )
                 if not silent or debug:
                     logger.warning(error)
-                if self.log is None:
-                    self.log = ""
-                self.log += f"{error}\n"
-                # We will not retry anymore (for now)
-                self.sending = False
-                # We make lower this email's priority
-                self.priority += 1
-                # Set we just made a new retry
-                self.retries += 1
-                self.next_retry = timezone.now() + timezone.timedelta(
-                    seconds=getattr(
-                        settings, "CLIENT_EMAIL_RETRIES_WAIT", 5400
-                    )
-                )  # retry every 1.5h
-                if self.retries >= getattr(
-                    settings, "CLIENT_EMAIL_RETRIES", 10
-                ):  # 10 retries * 1.5h = 15h
-                    self.error = True
+                self.add_attempt(error, e, connection, started)
+                connection = None
+                self.retry_later(e)
                 # Save all
-                self.save()
+                if commit:
+                    with timing.stage("save"):
+                        EmailMessage.save_status([self])
                 if not silent:
+                    self.end_timing(timing, commit)
                     raise
 
             if connection:
-                email = EM(
-                    subject=self.subject,
-                    body=self.body,
-                    from_email=self.efrom,
-                    to=[self.eto],
-                    connection=connection,
-                    headers=self.get_headers(legacy),
-                )
-                email.content_subtype = self.content_subtype
-                for at in self.attachments.all():
-                    with open(at.path) as f:
-                        email.attach(at.filename, f.read(), at.mime)
+                email = self.build_message(legacy, connection, timing)
 
                 # Send list emails if retries and not sent yet and not error
                 retries = 1
+                failure = None
                 while retries and not self.sent and not self.error:
                     error = None
+                    started = time.monotonic()
                     try:
-                        if connection.send_messages([email]):
+                        with timing.stage("data"):
+                            delivered = connection.send_messages([email])
+                        if delivered:
                             # We are done
                             self.sent = True
                             self.sending = False
+                            self.add_attempt(
+                                connection=connection, started=started
+                            )
                             break
                     except ssl.SSLError as e:
                         error = f"{self.eto}: SSLError: {e}\n"
+                        failure = e
                         if not silent or debug:
                             logger.warning(error)
-                        if self.log is None:
-                            self.log = ""
-                        self.log += f"{error}\n"
+                        self.add_attempt(error, e, connection, started)
                     except smtplib.SMTPServerDisconnected as e:
                         error = f"{self.eto}: SMTPServerDisconnected: {e}\n"
+                        failure = e
                         if not silent or debug:
                             logger.warning(error)
-                        if self.log is None:
-                            self.log = ""
-                        self.log += f"{error}\n"
+                        self.add_attempt(error, e, connection, started)
                         try:
+                            # Drop the dead session and open a new one
+                            connection.close()
                             connection.open()
                             error = None
                         except (
@@ -491,18 +1471,16 @@ class EmailMessage(CodenerixModel):
                             TimeoutError,
                         ) as e2:
                             error = f"{self.eto}: SMTPServerReconnect: {e2}\n"
+                            failure = e2
                             if not silent or debug:
                                 logger.warning(error)
-                            if self.log is None:
-                                self.log = ""
-                            self.log += f"{error}\n"
+                            self.add_attempt(error, e2, connection, started)
                     except smtplib.SMTPException as e:
                         error = f"{self.eto}: SMTPException: {e}\n"
+                        failure = e
                         if not silent or debug:
                             logger.warning(error)
-                        if self.log is None:
-                            self.log = ""
-                        self.log += f"{error}\n"
+                        self.add_attempt(error, e, connection, started)
                     finally:
 
                         # Retry if error
@@ -512,33 +1490,197 @@ class EmailMessage(CodenerixModel):
                             retries -= 1
                             # Check if this is the last try
                             if not retries:
-                                # We will not retry anymore (fow now)
-                                self.sending = False
-                                # We make lower this email's priority
-                                self.priority += 1
-                                # Set we just made a new retry
-                                self.retries += 1
-                                self.next_retry = (
-                                    timezone.now()
-                                    + timezone.timedelta(
-                                        seconds=getattr(
-                                            settings,
-                                            "CLIENT_EMAIL_RETRIES_WAIT",
-                                            5400,
-                                        )
-                                    )
-                                )  # retry every 1.5h
-                                if self.retries >= getattr(
-                                    settings, "CLIENT_EMAIL_RETRIES", 10
-                                ):  # 10 retries * 1.5h = 15h
-                                    self.error = True
+                                self.retry_later(failure)
+                                self.suppress_refused(failure)
 
                         # Save the email
-                        self.save()
-                        # Disconnect
+                        if commit:
+                            with timing.stage("save"):
+                                EmailMessage.save_status([self])
+                        # Keep persistent sessions open for the next email
+                        if not getattr(connection, "persistent", False):
+                            # Disconnect
+                            connection.close()
+                            # Connect
+                            connection = self.connect(legacy)
+
+            self.end_timing(timing, commit)
+
+    def end_timing(self, timing, commit):
+        """
+        Report the stages of sending this email, with commit=False they are
+        reported by save_status() once it knows how long saving took
+        """
+        if commit or not timing.enabled:
+            timing.end(sent=self.sent, error=self.error)
+        else:
+            self.timing = timing
+
+    async def asend(
+        self,
+        connection=None,
+        legacy=False,
+        silent=True,
+        debug=False,
+        commit=True,
+    ):
+        """
+        Async counterpart of send(), the outcome is recorded the same way.
+        The connection (from async_connect()) is left open for the next
+        email, when missing a new one is used just for this email. Check it
+        against a local SMTP sink with "manage.py emails_bench send --modes
+        async", which fails if any email is not delivered.
+        """
+
+        # Get connection if not connected yet
+        own = connection is None
+        if own:
+            if not silent or debug:
+                logger.warning("Not connected, connecting...")
+            connection = self.async_connect(legacy)
+
+        # Guards, nobody should try to send in this conditions
+        # 1: No destination
+        # 2: Already sent
+        # 3: Already in fatal error
+        if not (self.eto and not self.error and not self.sent):
+            return
+
+        # Never send to suppressed addresses
+        if await sync_to_async(self.suppressed)():
+            self.drop(f"{self.eto}: Suppressed")
+            if commit:
+                await sync_to_async(EmailMessage.save_status)([self])
+            return
+
+        # Measure the stages if requested (see codenerix_email.timing)
+        timing = get_timer().begin(self)
+
+        try:
+            # Open the connection
+            started = time.monotonic()
+            if not connection.is_connected:
+                try:
+                    with timing.stage("connect"):
+                        await connection.connect()
+                    metrics.SMTP_SECONDS.observe(
+                        time.monotonic() - started, stage="connect"
+                    )
+                except (
+                    aiosmtplib.SMTPException,
+                    OSError,
+                    TimeoutError,
+                ) as e:
+                    error = self.connect_error(
+                        e, getattr(connection, "connect_info", None)
+                    )
+                    if not silent or debug:
+                        logger.warning(error)
+                    self.add_attempt(error, e, connection, started)
+                    self.retry_later(e)
+                    # Save all
+                    if commit:
+                        with timing.stage("save"):
+                            await sync_to_async(EmailMessage.save_status)(
+                                [self]
+                            )
+                    self.end_timing(timing, commit)
+                    if not silent:
+                        raise
+                    return
+
+            email = await sync_to_async(self.build_message)(
+                legacy, timing=timing
+            )
+
+            # Try again once if the server closed the session
+            failure = None
+            for attempt in range(2):
+                error = None
+                if attempt:
+                    started = time.monotonic()
+                try:
+                    with timing.stage("data"):
+                        await self.asendmail(connection, email)
+                    # We are done
+                    self.sent = True
+                    self.sending = False
+                    self.add_attempt(connection=connection, started=started)
+                    break
+                except ssl.SSLError as e:
+                    error = f"{self.eto}: SSLError: {e}\n"
+                    failure = e
+                    if not silent or debug:
+                        logger.warning(error)
+                    self.add_attempt(error, e, connection, started)
+                    break
+                except aiosmtplib.SMTPServerDisconnected as e:
+                    error = f"{self.eto}: SMTPServerDisconnected: {e}\n"
+                    failure = e
+                    if not silent or debug:
+                        logger.warning(error)
+                    self.add_attempt(error, e, connection, started)
+                    if attempt:
+                        break
+                    try:
+                        # Drop the dead session and open a new one
                         connection.close()
-                        # Connect
-                        connection = self.connect(legacy)
+                        await connection.connect()
+                    except (
+                        aiosmtplib.SMTPException,
+                        OSError,
+                        TimeoutError,
+                    ) as e2:
+                        error = f"{self.eto}: SMTPServerReconnect: {e2}\n"
+                        failure = e2
+                        if not silent or debug:
+                            logger.warning(error)
+                        self.add_attempt(error, e2, connection, started)
+                        break
+                except aiosmtplib.SMTPException as e:
+                    error = f"{self.eto}: SMTPException: {e}\n"
+                    failure = e
+                    if not silent or debug:
+                        logger.warning(error)
+                    self.add_attempt(error, e, connection, started)
+                    break
+
+            # Retry later if error
+            if error:
+                self.retry_later(failure)
+                if refused(failure):
+                    await sync_to_async(self.suppress_refused)(failure)
+
+            # Save the email
+            if commit:
+                with timing.stage("save"):
+                    await sync_to_async(EmailMessage.save_status)([self])
+
+            self.end_timing(timing, commit)
+
+        finally:
+            # Disconnect if the connection was just for this email
+            if own and connection.is_connected:
+                try:
+                    await connection.quit()
+                except (aiosmtplib.SMTPException, OSError):
+                    connection.close()
+
+    @staticmethod
+    async def asendmail(connection, email):
+        """
+        Deliver a built message through an aiosmtplib client the same way
+        Django's SMTP backend does
+        """
+        encoding = email.encoding or settings.DEFAULT_CHARSET
+        from_email = sanitize_address(email.from_email, encoding)
+        recipients = [
+            sanitize_address(addr, encoding) for addr in email.recipients()
+        ]
+        message = email.message()
+        await connection.sendmail(
+            from_email, recipients, message.as_bytes(linesep="\r\n")
+        )
 
 
 class EmailAttachment(CodenerixModel):
@@ -556,6 +1698,14 @@ class EmailAttachment(CodenerixModel):
         _("Mimetype"), max_length=256, blank=False, null=False
     )
     path = models.FileField(_("Path"), blank=False, null=False)
+    sha256 = models.CharField(
+        _("SHA-256"),
+        max_length=64,
+        blank=True,
+        null=True,
+        db_index=True,
+        editable=False,
+    )
 
     def __fields__(self, info):
         fields = []
@@ -565,6 +1715,215 @@ class EmailAttachment(CodenerixModel):
         fields.append(("path", _("Path"), 100))
         return fields
 
+    def save(self, *args, **kwargs):
+        if self.path and not self.path._committed:
+            # New file, store it unless its content is stored already
+            (self.path.name, self.sha256) = self.store(
+                self.path.file, self.path.name
+            )
+            self.path._committed = True
+        elif self.path and not self.sha256:
+            self.sha256 = self.digest_of(self.path.name)
+        return super().save(*args, **kwargs)
+
+    @staticmethod
+    def digest(f):
+        """
+        SHA-256 of the content of a File
+        """
+        sha256 = hashlib.sha256()
+        for chunk in f.chunks():
+            sha256.update(chunk)
+        return sha256.hexdigest()
+
+    @classmethod
+    def digest_of(cls, name):
+        """
+        SHA-256 of a file in the storage, known attachments are not read
+        """
+        sha256 = (
+            cls.objects.filter(path=name, sha256__isnull=False)
+            .values_list("sha256", flat=True)
+            .first()
+        )
+        if sha256 is None:
+            storage = cls._meta.get_field("path").storage
+            with storage.open(name, "rb") as f:
+                sha256 = cls.digest(f)
+        return sha256
+
+    @classmethod
+    def store(cls, f, filename):
+        """
+        Save a File in the storage unless a file with the same content was
+        attached before, returns its (name, sha256)
+        """
+        sha256 = cls.digest(f)
+        name = (
+            cls.objects.filter(sha256=sha256)
+            .exclude(path="")
+            .values_list("path", flat=True)
+            .first()
+        )
+        if name is None:
+            storage = cls._meta.get_field("path").storage
+            name = storage.save(f.name or filename, f)
+        return (name, sha256)
+
+    def encode(self):
+        """
+        Read the file from the storage in binary chunks of
+        CLIENT_EMAIL_ATTACHMENT_CHUNK bytes and encode it to base64 as it is
+        read, the SHA-256 is computed on the way if it is unknown
+        """
+        # Full base64 lines are 57 bytes long, so the chunks must be
+        # multiple of it to join their encodings
+        chunk_size = getattr(settings, "CLIENT_EMAIL_ATTACHMENT_CHUNK", 65536)
+        chunk_size = max(57, chunk_size - chunk_size % 57)
+
+        encoded = io.StringIO()
+        sha256 = hashlib.sha256()
+        with self.path.open("rb") as f:
+            for chunk in f.chunks(chunk_size):
+                encoded.write(base64.encodebytes(chunk).decode("ascii"))
+                sha256.update(chunk)
+
+        if not self.sha256:
+            # Remember it for the next time (attachments of older versions)
+            self.sha256 = sha256.hexdigest()
+            if self.pk:
+                EmailAttachment.objects.filter(pk=self.pk).update(
+                    sha256=self.sha256
+                )
+
+        return encoded.getvalue()
+
+    def mime_part(self):
+        """
+        Build the MIME part for this attachment, the base64 encoding is kept
+        in memory by content, so the same file is encoded just once for all
+        the emails it is attached to (see CLIENT_EMAIL_ATTACHMENT_CACHE_SIZE)
+        """
+        (maintype, subtype) = (
+            self.mime or "application/octet-stream"
+        ).split("/", 1)
+
+        encoded = cache.attachments.get(self.sha256) if self.sha256 else None
+        if encoded is None:
+            encoded = self.encode()
+            cache.attachments.set(self.sha256, encoded)
+
+        part = MIMEBase(maintype, subtype)
+        part.set_payload(encoded)
+        part["Content-Transfer-Encoding"] = "base64"
+
+        # Non ASCII filenames are encoded as Django does
+        filename = self.filename
+        try:
+            filename.encode("ascii")
+        except UnicodeEncodeError:
+            filename = ("utf-8", "", filename)
+        part.add_header("Content-Disposition", "attachment", filename=filename)
+        return part
+
+
+class EmailDeliveryAttempt(CodenerixModel):
+    email = models.ForeignKey(
+        EmailMessage,
+        on_delete=models.CASCADE,
+        blank=False,
+        null=False,
+        related_name="attempts",
+    )
+    date = models.DateTimeField(_("Date"), default=timezone.now, db_index=True)
+    sent = models.BooleanField(
+        _("Sent"), blank=False, null=False, default=False
+    )
+    code = models.PositiveSmallIntegerField(
+        _("SMTP code"), blank=True, null=True
+    )
+    exception = models.CharField(
+        _("Exception"), max_length=128, blank=True, null=False, default=""
+    )
+    host = models.CharField(
+        _("Host"), max_length=256, blank=True, null=False, default=""
+    )
+    duration = models.FloatField(
+        _("Duration"), blank=True, null=True, help_text=_("In seconds")
+    )
+    message = models.TextField(_("Message"), blank=True, null=False)
+
+    class Meta(CodenerixModel.Meta):
+        ordering = ["date", "pk"]
+
+    def __fields__(self, info):
+        fields = []
+        fields.append(("email", _("Email"), 100))
+        fields.append(("date", _("Date"), 100))
+        fields.append(("sent", _("Sent"), 100))
+        fields.append(("code", _("SMTP code"), 100))
+        fields.append(("exception", _("Exception"), 100))
+        fields.append(("host", _("Host"), 100))
+        fields.append(("duration", _("Duration"), 100))
+        return fields
+
+
+class EmailSuppression(CodenerixModel):
+    email = models.EmailField(_("Email"), unique=True)
+    reason = models.CharField(
+        _("Reason"),
+        max_length=1,
+        choices=SUPPRESSION_REASONS,
+        default=SUPPRESSION_MANUAL,
+    )
+    code = models.PositiveSmallIntegerField(
+        _("SMTP code"), blank=True, null=True
+    )
+    detail = models.TextField(_("Detail"), blank=True, null=False)
+
+    def __str__(self):
+        return self.email
+
+    def __fields__(self, info):
+        fields = []
+        fields.append(("email", _("Email"), 100))
+        fields.append(("reason", _("Reason"), 100))
+        fields.append(("code", _("SMTP code"), 100))
+        fields.append(("created", _("Created"), 100))
+        return fields
+
+    @classmethod
+    def suppress(
+        cls, address, reason=SUPPRESSION_MANUAL, code=None, detail=""
+    ):
+        """
+        Stop sending emails to address
+        """
+        (suppression, created) = cls.objects.update_or_create(
+            email=address.strip().lower(),
+            defaults={"reason": reason, "code": code, "detail": detail},
+        )
+        return suppression
+
+    @classmethod
+    def is_suppressed(cls, address):
+        return cls.objects.filter(email=address.strip().lower()).exists()
+
+    @classmethod
+    def suppressed_among(cls, addresses):
+        """
+        Set of the given addresses (in lower case) which are suppressed,
+        checked with a single query
+        """
+        addresses = {a.strip().lower() for a in addresses if a}
+        if not addresses:
+            return set()
+        return set(
+            cls.objects.filter(email__in=addresses).values_list(
+                "email", flat=True
+            )
+        )
+
 
 class EmailReceived(CodenerixModel):
     imap_id = models.IntegerField(
@@ -666,6 +2025,24 @@ class EmailReceived(CodenerixModel):
     def headers_pretty(self) -> Optional[SafeString]:
         return self.__prettyfy__(self.headers)
 
+    def suppression(self):
+        """
+        Return the (address, reason) which should not get more emails
+        because of this one (a hard bounce or an unsubscribe request replying
+        to one of our emails), or None
+        """
+        address = self.email.eto if self.email_id else None
+        if self.bounce_type == BOUNCE_HARD:
+            if not address:
+                # Bounce not linked to our email, use the failed recipient
+                failed = (self.headers or {}).get("X-Failed-Recipients")
+                address = (failed or "").split(",")[0].strip()
+            if address:
+                return (address, SUPPRESSION_BOUNCE)
+        elif address and re.match(r"^\s*unsubscribe\b", self.subject, re.I):
+            return (address, SUPPRESSION_UNSUBSCRIBE)
+        return None
+
 
 class EmailTemplate(CodenerixModel):
     cid = models.CharField(
@@ -715,21 +2092,95 @@ class EmailTemplate(CodenerixModel):
         else:
             return None
 
+    def compiled(self, lang):
+        """
+        Return the compiled (subject, body, efrom) templates for a language,
+        they are cached by template, language and last update
+        """
+        key = (self.pk, lang, self.updated)
+        compiled = cache.templates.get(key) if self.pk else None
+        if compiled is None:
+            text = getattr(self, lang)
+            compiled = (
+                Template(text.subject),
+                Template(text.body),
+                Template(self.efrom),
+            )
+            if self.pk:
+                cache.templates.set(key, compiled)
+        return compiled
+
+    @staticmethod
+    def forget(pk):
+        """
+        Drop the compiled templates of an EmailTemplate from the cache
+        """
+        cache.templates.discard(lambda key: key[0] == pk)
+
     def get_email(self, context, lang=None):
         if lang is None:
             lang = settings.LANGUAGES_DATABASES[0].lower()
 
+        (subject, body, efrom) = self.compiled(lang)
+
         e = EmailMessage()
         context["CDNX_EMAIL_emsg_uuid"] = e.uuid
-        e.subject = Template(getattr(self, lang).subject).render(
-            Context(context)
-        )
-        e.body = Template(getattr(self, lang).body).render(Context(context))
-        e.efrom = Template(self.efrom).render(Context(context))
+        e.subject = subject.render(Context(context))
+        e.body = body.render(Context(context))
+        e.efrom = efrom.render(Context(context))
         e.content_subtype = self.content_subtype
 
         return e
 
+    def render_many(self, contexts, lang=None, processes=None, chunk_size=100):
+        """
+        Render this template for every context, yielding the EmailMessage
+        instances (not saved) one by one in the same order.
+
+        The template is compiled once. With processes the rendering is
+        spread over a pool of processes, contexts must be picklable then
+        and they are sent to the pool in chunks of chunk_size per process.
+        """
+        if lang is None:
+            lang = settings.LANGUAGES_DATABASES[0].lower()
+
+        if not processes:
+            for context in contexts:
+                yield self.get_email(context, lang)
+            return
+
+        # Source of the templates for the pool
+        text = getattr(self, lang)
+        sources = (text.subject, text.body, self.efrom)
+
+        contexts = iter(contexts)
+        with ProcessPoolExecutor(
+            processes, initializer=django.setup
+        ) as executor:
+            while True:
+                emails = []
+                jobs = []
+                for context in islice(contexts, chunk_size * processes):
+                    e = EmailMessage()
+                    e.content_subtype = self.content_subtype
+                    context["CDNX_EMAIL_emsg_uuid"] = e.uuid
+                    emails.append(e)
+                    jobs.append(context)
+                if not jobs:
+                    break
+
+                rendered = executor.map(
+                    render_email,
+                    [sources] * len(jobs),
+                    jobs,
+                    chunksize=chunk_size,
+                )
+                for e, (subject, body, efrom) in zip(emails, rendered):
+                    e.subject = subject
+                    e.body = body
+                    e.efrom = efrom
+                    yield e
+
     def clean(self):
         if self.cid:
             self.cid = self.cid.upper()
@@ -742,6 +2193,22 @@ class EmailTemplate(CodenerixModel):
                 )
 
 
+@lru_cache(maxsize=16)
+def compile_email(sources):
+    return tuple(Template(source) for source in sources)
+
+
+def render_email(sources, context):
+    """
+    Render the (subject, body, efrom) template sources, used by the process
+    pool of EmailTemplate.render_many()
+    """
+    return tuple(
+        template.render(Context(context))
+        for template in compile_email(sources)
+    )
+
+
 class GenText(CodenerixModel):  # META: Abstract class
     class Meta(CodenerixModel.Meta):
         abstract = True
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+#
+# django-codenerix-email
+#
+# Codenerix GNU
+#
+# Project URL : http://www.codenerix.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import smtplib
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+try:
+    import aiosmtplib
+except ImportError:  # pragma: no cover
+    aiosmtplib = None
+
+# Kinds of failures
+CONNECTION = "connection"
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+
+AUTH_ERRORS = (smtplib.SMTPAuthenticationError,)
+SENDER_ERRORS = (smtplib.SMTPSenderRefused,)
+REFUSED_ERRORS = (smtplib.SMTPRecipientsRefused,)
+if aiosmtplib is not None:
+    AUTH_ERRORS += (aiosmtplib.SMTPAuthenticationError,)
+    SENDER_ERRORS += (aiosmtplib.SMTPSenderRefused,)
+    REFUSED_ERRORS += (
+        aiosmtplib.SMTPRecipientsRefused,
+        aiosmtplib.SMTPRecipientRefused,
+    )
+
+
+def smtp_code(e):
+    """
+    SMTP reply code carried by an exception, if any
+    """
+    # smtplib uses smtp_code and aiosmtplib code
+    code = getattr(e, "smtp_code", None) or getattr(e, "code", None)
+    recipients = getattr(e, "recipients", None)
+    if code is None and recipients:
+        if isinstance(recipients, dict):
+            # smtplib: {address: (code, message)}
+            code = next(iter(recipients.values()))[0]
+        else:
+            # aiosmtplib: [SMTPRecipientRefused]
+            code = getattr(recipients[0], "code", None)
+    return code if isinstance(code, int) else None
+
+
+def classify(exception):
+    """
+    Tell the kind of a delivery failure:
+        CONNECTION: we couldn't talk to the relay (down, timeout, login,
+                    sender refused like "530 Authentication required"...)
+        TRANSIENT: the server asks us to come back later (4xx) or failed
+                   without a reply code
+        PERMANENT: the server replied 5xx (like "550 user unknown" or "554
+                   message rejected"), only refusals of the recipient make
+                   the email give up (see refused())
+    """
+    if exception is None:
+        return TRANSIENT
+    if isinstance(exception, AUTH_ERRORS + SENDER_ERRORS):
+        # The relay refuses us, not the email
+        return CONNECTION
+    code = smtp_code(exception)
+    if code:
+        return PERMANENT if code >= 500 else TRANSIENT
+    # SMTP exceptions without a reply code are OSErrors too
+    if isinstance(exception, (OSError, TimeoutError)):
+        return CONNECTION
+    return TRANSIENT
+
+
+def refused(exception):
+    """
+    Tell if the server permanently refused the recipient (like "550 user
+    unknown"), so the address should not get more emails
+    """
+    return (
+        isinstance(exception, REFUSED_ERRORS)
+        and classify(exception) == PERMANENT
+    )
+
+
+class RetryPolicy:
+    """
+    Decides when a failed email is tried again, set CLIENT_EMAIL_RETRY_POLICY
+    to the dotted path of a subclass to use your own
+    """
+
+    def give_up(self, email, exception=None):
+        """
+        Tell if email must not be tried again after exception, by default
+        5xx refusals of the recipient are not retried unless
+        CLIENT_EMAIL_FAIL_FAST is False, other permanent failures are tried
+        again on their own schedule
+        """
+        return getattr(settings, "CLIENT_EMAIL_FAIL_FAST", True) and refused(
+            exception
+        )
+
+    def schedule(self, email, exception=None):
+        """
+        Return (seconds, demote) for the next try of email after exception,
+        demote tells if its priority should be lowered
+        """
+        raise NotImplementedError
+
+
+class FixedRetryPolicy(RetryPolicy):
+    """
+    Retry every CLIENT_EMAIL_RETRIES_WAIT seconds lowering the priority, as
+    older versions did
+    """
+
+    def schedule(self, email, exception=None):
+        return (getattr(settings, "CLIENT_EMAIL_RETRIES_WAIT", 5400), True)
+
+
+class ExponentialBackoff(RetryPolicy):
+    """
+    Wait base * factor ** retries seconds (up to max) with a random jitter,
+    so emails failing together are not tried again together. Every kind of
+    failure has its own schedule, which can be changed with
+    CLIENT_EMAIL_RETRY_SCHEDULES:
+
+        CLIENT_EMAIL_RETRY_SCHEDULES = {
+            "connection": {"base": 30, "max": 600},
+        }
+
+    Connection errors are not the email's fault, so its priority is kept
+    and their schedule is as long as the old fixed one: with the default 10
+    CLIENT_EMAIL_RETRIES and 1.5h of CLIENT_EMAIL_RETRIES_WAIT, an email
+    survives a relay outage of 14.5h (120s doubling up to 6h) before it is
+    marked as failed. CLIENT_EMAIL_RETRY_JITTER is the fraction of the wait
+    added at random (default 0.5), it only makes waits longer so the
+    schedules are the shortest the queue keeps an email.
+    """
+
+    def __init__(self, schedules=None, jitter=None):
+        wait = getattr(settings, "CLIENT_EMAIL_RETRIES_WAIT", 5400)
+        self.schedules = {
+            CONNECTION: {
+                "base": 120,
+                "factor": 2,
+                "max": wait * 4,
+                "demote": False,
+            },
+            TRANSIENT: {"base": 300, "factor": 2, "max": wait, "demote": True},
+            PERMANENT: {
+                "base": 3600,
+                "factor": 4,
+                "max": 86400,
+                "demote": True,
+            },
+        }
+        if schedules is None:
+            schedules = getattr(settings, "CLIENT_EMAIL_RETRY_SCHEDULES", {})
+        for kind, schedule in schedules.items():
+            self.schedules[kind] = {**self.schedules[kind], **schedule}
+        if jitter is None:
+            jitter = getattr(settings, "CLIENT_EMAIL_RETRY_JITTER", 0.5)
+        self.jitter = jitter
+
+    def schedule(self, email, exception=None):
+        schedule = self.schedules[classify(exception)]
+        wait = min(
+            schedule["max"],
+            schedule["base"] * schedule["factor"] ** email.retries,
+        )
+        wait *= 1 + self.jitter * random.random()
+        return (wait, schedule["demote"])
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+
+def get_retry_policy():
+    """
+    Return the retry policy configured in CLIENT_EMAIL_RETRY_POLICY
+    """
+    global _policy
+    with _policy_lock:
+        if _policy is None:
+            path = getattr(
+                settings,
+                "CLIENT_EMAIL_RETRY_POLICY",
+                "codenerix_email.retry.ExponentialBackoff",
+            )
+            _policy = import_string(path)()
+        return _policy
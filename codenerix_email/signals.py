@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+#
+# django-codenerix-email
+#
+# Codenerix GNU
+#
+# Project URL : http://www.codenerix.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from codenerix_email import models
+from codenerix_email.models import (
+    EmailMessage,
+    EmailReceived,
+    EmailSuppression,
+    EmailTemplate,
+)
+from codenerix_email.wakeup import get_channel
+
+
+@receiver(post_save, sender=EmailMessage)
+def emailmessage_wakeup(sender, instance, **kwargs):
+    # Wake up the daemon when an email is ready to be sent
+    if (
+        not instance.sent
+        and not instance.sending
+        and not instance.error
+        and (
+            instance.next_retry is None
+            or instance.next_retry <= timezone.now()
+        )
+    ):
+        transaction.on_commit(get_channel().notify)
+
+
+@receiver(post_save, sender=EmailReceived)
+def emailreceived_suppress(sender, instance, **kwargs):
+    # Stop sending to hard bounced and unsubscribed addresses
+    if getattr(settings, "CLIENT_EMAIL_SUPPRESSION", False):
+        suppression = instance.suppression()
+        if suppression:
+            (address, reason) = suppression
+            EmailSuppression.suppress(
+                address,
+                reason,
+                detail=" ".join(
+                    filter(None, [instance.eid, instance.bounce_reason])
+                ),
+            )
+
+
+@receiver(post_save, sender=EmailTemplate)
+@receiver(post_delete, sender=EmailTemplate)
+def emailtemplate_changed(sender, instance, **kwargs):
+    # Compiled templates are outdated
+    EmailTemplate.forget(instance.pk)
+
+
+def emailtemplatetext_changed(sender, instance, **kwargs):
+    # Touch the template so its cache key changes in every process
+    EmailTemplate.objects.filter(pk=instance.email_template_id).update(
+        updated=timezone.now()
+    )
+    EmailTemplate.forget(instance.email_template_id)
+
+
+for lang_code in settings.LANGUAGES_DATABASES:
+    model = getattr(models, f"EmailTemplateText{lang_code}")
+    post_save.connect(emailtemplatetext_changed, sender=model)
+    post_delete.connect(emailtemplatetext_changed, sender=model)
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+#
+# django-codenerix-email
+#
+# Codenerix GNU
+#
+# Project URL : http://www.codenerix.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import smtplib
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.mail.backends.smtp import EmailBackend as SMTPBackend
+from django.core.mail.utils import DNS_NAME
+
+from codenerix_email.timing import NULL_TIMING
+
+
+def open_backend(backend, timing=None):
+    """
+    Same as backend.open(), but recording how long the connect, TLS and AUTH
+    steps take in timing (see codenerix_email.timing) when the backend opens
+    sessions as Django's SMTP backend does (backends with their own open(),
+    like SSLEmailBackend, are timed as a single connect stage)
+    """
+    if (
+        timing is None
+        or not timing.enabled
+        or not isinstance(backend, SMTPBackend)
+        or type(backend).open is not SMTPBackend.open
+    ):
+        with (timing or NULL_TIMING).stage("connect"):
+            return backend.open()
+    if backend.connection:
+        return False
+
+    # Follow the steps of SMTPBackend.open()
+    params = {"local_hostname": DNS_NAME.get_fqdn()}
+    if backend.timeout is not None:
+        params["timeout"] = backend.timeout
+    if backend.use_ssl:
+        params["context"] = backend.ssl_context
+    try:
+        with timing.stage("connect"):
+            connection = backend.connection_class(
+                backend.host, backend.port, **params
+            )
+        try:
+            if not backend.use_ssl and backend.use_tls:
+                with timing.stage("tls"):
+                    connection.starttls(context=backend.ssl_context)
+            if backend.username and backend.password:
+                with timing.stage("auth"):
+                    connection.login(backend.username, backend.password)
+        except BaseException:
+            connection.close()
+            raise
+        backend.connection = connection
+        return True
+    except OSError:
+        if not backend.fail_silently:
+            raise
+
+
+class PersistentConnection:
+    """
+    Wraps an email backend to keep one authenticated SMTP session open
+    across several messages.
+
+    The session is renewed only when the server disconnects or after
+    CLIENT_EMAIL_CONNECTION_MAX_MESSAGES messages or
+    CLIENT_EMAIL_CONNECTION_MAX_IDLE idle seconds (0 disables each limit).
+    """
+
+    persistent = True
+
+    def __init__(
+        self, backend, connect_info=None, max_messages=None, max_idle=None
+    ):
+        self.backend = backend
+        self.connect_info = connect_info or {}
+        if max_messages is None:
+            max_messages = getattr(
+                settings, "CLIENT_EMAIL_CONNECTION_MAX_MESSAGES", 100
+            )
+        if max_idle is None:
+            max_idle = getattr(
+                settings, "CLIENT_EMAIL_CONNECTION_MAX_IDLE", 30
+            )
+        self.max_messages = max_messages
+        self.max_idle = max_idle
+        self.messages = 0
+        self.opened = None
+        self.last_used = None
+
+    @property
+    def is_open(self):
+        return getattr(self.backend, "connection", None) is not None
+
+    def age(self):
+        """
+        Seconds since the current session was opened
+        """
+        if self.opened is None:
+            return 0
+        return time.monotonic() - self.opened
+
+    def expired(self):
+        """
+        Tell if the open session should not be used anymore
+        """
+        if not self.is_open:
+            return False
+        if self.max_messages and self.messages >= self.max_messages:
+            return True
+        if (
+            self.max_idle
+            and self.last_used is not None
+            and time.monotonic() - self.last_used > self.max_idle
+        ):
+            return True
+        return False
+
+    def open(self, timing=None):
+        """
+        Make sure there is a usable session open, returns True if a new one
+        was opened
+        """
+        if self.expired():
+            self.close()
+        if self.is_open:
+            return False
+        opened = open_backend(self.backend, timing)
+        self.messages = 0
+        self.opened = self.last_used = time.monotonic()
+        return opened
+
+    def reopen(self):
+        """
+        Drop the current session (it may be dead already) and open a new one
+        """
+        self.close()
+        return self.open()
+
+    def close(self):
+        self.backend.close()
+        self.messages = 0
+        self.opened = None
+
+    def send_messages(self, email_messages):
+        self.open()
+        sent = self.backend.send_messages(email_messages)
+        self.messages += len(email_messages)
+        self.last_used = time.monotonic()
+        return sent
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """
+        Submit a raw message through the open session, returns the refused
+        recipients as smtplib does
+        """
+        self.open()
+        refused = self.backend.connection.sendmail(from_addr, to_addrs, msg)
+        self.messages += 1
+        self.last_used = time.monotonic()
+        return refused
+
+
+class SMTPConnectionPool:
+    """
+    Bounded pool of authenticated SMTP sessions, shared by the threads of a
+    process.
+
+    Sessions are grouped by key (the (host, port, username, use_tls, legacy)
+    tuple from EmailMessage.connection_key()), and no more than
+    CLIENT_EMAIL_POOL_SIZE sessions per key are checked out at once, so
+    concurrent senders stay below the relay's session limit. Idle sessions
+    are checked with NOOP before being handed out and closed after
+    CLIENT_EMAIL_POOL_MAX_AGE seconds.
+    """
+
+    def __init__(self, size=None, max_age=None, timeout=None):
+        if size is None:
+            size = getattr(settings, "CLIENT_EMAIL_POOL_SIZE", 4)
+        if max_age is None:
+            max_age = getattr(settings, "CLIENT_EMAIL_POOL_MAX_AGE", 300)
+        if timeout is None:
+            timeout = getattr(settings, "CLIENT_EMAIL_POOL_TIMEOUT", 30)
+        self.size = size
+        self.max_age = max_age
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+
+    def _slot(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.size)
+                self._idle[key] = []
+            return self._slots[key]
+
+    def healthy(self, connection):
+        """
+        Tell if an idle session can still be used
+        """
+        if not connection.is_open or connection.expired():
+            return False
+        if self.max_age and connection.age() > self.max_age:
+            return False
+        try:
+            code, _ = connection.backend.connection.noop()
+        except (smtplib.SMTPException, OSError):
+            return False
+        return code == 250
+
+    def checkout(self, key, factory):
+        """
+        Get a session for key, factory() builds a new PersistentConnection
+        when there is no idle one available (it is opened when first used,
+        so EmailMessage.send() records the failure if it can't connect)
+        """
+        slot = self._slot(key)
+        if not slot.acquire(timeout=self.timeout):
+            raise TimeoutError(
+                f"No SMTP session available in the pool after "
+                f"{self.timeout} seconds"
+            )
+
+        try:
+            # Reuse an idle session if it is still alive
+            while True:
+                with self._lock:
+                    if not self._idle[key]:
+                        break
+                    connection = self._idle[key].pop()
+                if self.healthy(connection):
+                    return connection
+                connection.close()
+
+            # New session
+            return factory()
+        except BaseException:
+            slot.release()
+            raise
+
+    def checkin(self, key, connection):
+        """
+        Give back a session to the pool
+        """
+        if (
+            connection.is_open
+            and not connection.expired()
+            and not (self.max_age and connection.age() > self.max_age)
+        ):
+            with self._lock:
+                self._idle[key].append(connection)
+        else:
+            connection.close()
+        self._slots[key].release()
+
+    @contextmanager
+    def connection(self, key, factory):
+        connection = self.checkout(key, factory)
+        try:
+            yield connection
+        finally:
+            self.checkin(key, connection)
+
+    def close(self):
+        """
+        Close all idle sessions
+        """
+        with self._lock:
+            idle = [c for conns in self._idle.values() for c in conns]
+            for conns in self._idle.values():
+                conns.clear()
+        for connection in idle:
+            connection.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Return the SMTP connection pool of this process
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SMTPConnectionPool()
+        return _pool
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# django-codenerix-email
+#
+# Codenerix GNU
+#
+# Project URL : http://www.codenerix.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import threading
+from itertools import chain, zip_longest
+
+from django.conf import settings
+
+
+def domain_of(address):
+    """
+    Domain of an email address in lower case
+    """
+    return (address or "").rpartition("@")[2].strip().strip(">").lower()
+
+
+def interleave(rows):
+    """
+    Reorder (pk, eto) rows taking one email of each domain in turn, the
+    order of the emails of the same domain is kept
+    """
+    domains = {}
+    for row in rows:
+        domains.setdefault(domain_of(row[1]), []).append(row)
+    return [
+        row
+        for row in chain.from_iterable(zip_longest(*domains.values()))
+        if row is not None
+    ]
+
+
+class DomainLimit:
+    """
+    Token bucket of a recipient domain: up to rate emails per second with
+    bursts of burst emails, and no more than concurrency sessions at once
+    (None disables each limit)
+    """
+
+    def __init__(self, rate=None, burst=None, concurrency=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate or 1)
+        self.concurrency = concurrency
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.active = 0
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.last) * self.rate
+            )
+        self.last = now
+
+    def acquire(self):
+        """
+        Take a token and a session, returns 0 if they were available or the
+        seconds to wait before trying again
+        """
+        if self.concurrency and self.active >= self.concurrency:
+            # Try again soon, a session will be free by then
+            return 1 / self.rate if self.rate else 1
+        if self.rate:
+            self.refill()
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        self.active += 1
+        return 0
+
+    def release(self):
+        self.active -= 1
+
+
+class DomainThrottle:
+    """
+    Shape the outbound mail by recipient domain so no provider gets a burst
+    from us, configured in CLIENT_EMAIL_DOMAIN_RATES:
+
+        CLIENT_EMAIL_DOMAIN_RATES = {
+            "gmail.com": {"rate": 5, "burst": 10, "concurrency": 2},
+            "outlook.com": {"rate": 2, "concurrency": 1},
+            "*": {"rate": 20},
+        }
+
+    rate is in emails per second and "*" applies to every other domain (each
+    one with its own bucket). The limits are kept in each process, so share
+    them out between the daemons sending at once.
+    """
+
+    def __init__(self, rates=None):
+        if rates is None:
+            rates = getattr(settings, "CLIENT_EMAIL_DOMAIN_RATES", None) or {}
+        self.rates = {domain.lower(): conf for (domain, conf) in rates.items()}
+        self.limits = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.rates)
+
+    def _limit(self, domain):
+        limit = self.limits.get(domain)
+        if limit is None:
+            conf = self.rates.get(domain, self.rates.get("*"))
+            if conf is None:
+                return None
+            limit = self.limits[domain] = DomainLimit(**conf)
+        return limit
+
+    def acquire(self, address):
+        """
+        Reserve the delivery of an email to address, returns 0 when it can
+        be sent now (call release() after) or the seconds to defer it
+        """
+        with self._lock:
+            limit = self._limit(domain_of(address))
+            if limit is None:
+                return 0
+            return limit.acquire()
+
+    def release(self, address):
+        with self._lock:
+            limit = self._limit(domain_of(address))
+            if limit is not None:
+                limit.release()
+
+
+_throttle = None
+_throttle_lock = threading.Lock()
+
+
+def get_throttle():
+    """
+    Return the domain throttle of this process
+    """
+    global _throttle
+    with _throttle_lock:
+        if _throttle is None:
+            _throttle = DomainThrottle()
+        return _throttle
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+#
+# django-codenerix-email
+#
+# Codenerix GNU
+#
+# Project URL : http://www.codenerix.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import logging
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from codenerix_email import metrics
+
+logger = logging.getLogger("CodenerixEmail:Timing")
+
+TIMERS = {
+    "log": "codenerix_email.timing.LoggingTimer",
+    "metrics": "codenerix_email.timing.MetricsTimer",
+}
+
+# Stages of EmailMessage.send()
+STAGES = (
+    "connect",
+    "tls",
+    "auth",
+    "headers",
+    "mime",
+    "attachments",
+    "data",
+    "save",
+)
+
+STAGE_SECONDS = metrics.Histogram(
+    "codenerix_email_send_stage_seconds",
+    "Time spent in every stage of sending an email",
+    ["stage"],
+)
+
+
+class NullStage:
+    """
+    Stage which doesn't measure anything
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class NullTiming:
+    """
+    Timing of a message when nobody is listening, it does nothing
+    """
+
+    enabled = False
+    null_stage = NullStage()
+
+    def stage(self, name):
+        return self.null_stage
+
+    def end(self, **info):
+        pass
+
+
+NULL_TIMING = NullTiming()
+
+
+class Stage:
+    def __init__(self, timing, name):
+        self.timing = timing
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timing.add(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class Timing:
+    """
+    Durations of the stages of sending one email, given to the timer when
+    the email is done
+    """
+
+    enabled = True
+
+    def __init__(self, timer, email):
+        self.timer = timer
+        self.email = email
+        self.stages = {}
+
+    def stage(self, name):
+        """
+        Context manager measuring a stage, the time of a stage entered twice
+        (like when the session is reopened) is added up
+        """
+        return Stage(self, name)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def end(self, **info):
+        self.timer.report(self.email, self.stages, **info)
+
+
+class SendTimer:
+    """
+    Gets how long every stage of EmailMessage.send() took for each email
+    (see STAGES). This one is disabled, set CLIENT_EMAIL_SEND_TIMER to
+    "log", "metrics" or the dotted path of a subclass implementing report()
+    to enable it.
+    """
+
+    enabled = False
+
+    def begin(self, email):
+        """
+        Start timing the delivery of email
+        """
+        if not self.enabled:
+            return NULL_TIMING
+        return Timing(self, email)
+
+    def report(self, email, stages, **info):
+        """
+        Called once the email is done with {stage: seconds} of the stages it
+        went through and info about the outcome (like sent=True)
+        """
+
+
+class LoggingTimer(SendTimer):
+    """
+    Log the stages of every email at INFO level, the values are in the
+    record too (record.email and record.stages) for structured handlers
+    """
+
+    enabled = True
+
+    def report(self, email, stages, **info):
+        detail = " ".join(
+            f"{stage}={seconds * 1000:.1f}ms"
+            for (stage, seconds) in stages.items()
+        )
+        logger.info(
+            f"Email {email.pk} to {email.eto}: {detail}",
+            extra={"email": email.pk, "stages": stages, **info},
+        )
+
+
+class MetricsTimer(SendTimer):
+    """
+    Observe the stages in the codenerix_email_send_stage_seconds histogram
+    (see codenerix_email.metrics)
+    """
+
+    enabled = True
+
+    def report(self, email, stages, **info):
+        for (stage, seconds) in stages.items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+_timer = None
+_timer_lock = threading.Lock()
+
+
+def get_timer():
+    """
+    Return the send timer configured in CLIENT_EMAIL_SEND_TIMER
+    """
+    global _timer
+    with _timer_lock:
+        if _timer is None:
+            path = getattr(settings, "CLIENT_EMAIL_SEND_TIMER", None)
+            if path:
+                _timer = import_string(TIMERS.get(path, path))()
+            else:
+                _timer = SendTimer()
+        return _timer
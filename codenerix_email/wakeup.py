@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+#
+# django-codenerix-email
+#
+# Codenerix GNU
+#
+# Project URL : http://www.codenerix.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import select
+import socket
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connections
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger("CodenerixEmail:Wakeup")
+
+CHANNELS = {
+    "socket": "codenerix_email.wakeup.SocketWakeupChannel",
+    "postgresql": "codenerix_email.wakeup.PostgreSQLWakeupChannel",
+}
+
+
+class WakeupChannel:
+    """
+    Lets the emails_send daemon know there are new emails in the queue.
+
+    This one doesn't notify anything, the daemon just polls the queue every
+    CLIENT_EMAIL_POLL_INTERVAL seconds. Set CLIENT_EMAIL_WAKEUP to "socket",
+    "postgresql" or the dotted path of a WakeupChannel subclass to get
+    notifications.
+    """
+
+    def __init__(self):
+        self.max_wait = getattr(settings, "CLIENT_EMAIL_POLL_INTERVAL", 10)
+
+    def notify(self):
+        """
+        Wake up the daemons waiting for emails (called by the senders)
+        """
+
+    def wait(self, timeout):
+        """
+        Wait until notified or timeout seconds, returns True if notified
+        """
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+class SocketWakeupChannel(WakeupChannel):
+    """
+    Notifies through a UDP datagram sent to CLIENT_EMAIL_WAKEUP_ADDRESS
+    (default 127.0.0.1:8026), the daemon must run where it points to. Only
+    one daemon per host can listen, the others poll the queue every
+    CLIENT_EMAIL_POLL_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.max_wait = getattr(settings, "CLIENT_EMAIL_WAKEUP_MAX_WAIT", 300)
+        self.address = tuple(
+            getattr(
+                settings, "CLIENT_EMAIL_WAKEUP_ADDRESS", ("127.0.0.1", 8026)
+            )
+        )
+        self.listener = None
+        self.polling = False
+
+    def notify(self):
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.sendto(b"1", self.address)
+        except OSError as e:
+            logger.warning(f"Couldn't notify the email daemon: {e}")
+
+    def listen(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            listener.bind(self.address)
+        except OSError:
+            listener.close()
+            raise
+        listener.setblocking(False)
+        self.listener = listener
+
+    def wait(self, timeout):
+        if self.listener is None and not self.polling:
+            try:
+                self.listen()
+            except OSError as e:
+                # Another daemon on this host is listening already
+                logger.warning(
+                    f"Couldn't listen for notifications on {self.address}: "
+                    f"{e}, polling the queue instead"
+                )
+                self.polling = True
+                self.max_wait = getattr(
+                    settings, "CLIENT_EMAIL_POLL_INTERVAL", 10
+                )
+        if self.polling:
+            return super().wait(min(timeout, self.max_wait))
+
+        (ready, _, _) = select.select([self.listener], [], [], timeout)
+        if ready:
+            # Drain all pending notifications
+            try:
+                while self.listener.recv(64):
+                    pass
+            except BlockingIOError:
+                pass
+            return True
+        return False
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+
+class PostgreSQLWakeupChannel(WakeupChannel):
+    """
+    Notifies with PostgreSQL LISTEN/NOTIFY on CLIENT_EMAIL_WAKEUP_CHANNEL
+    (default "codenerix_email"), it works for daemons on any host.
+    """
+
+    def __init__(self, using="default"):
+        self.max_wait = getattr(settings, "CLIENT_EMAIL_WAKEUP_MAX_WAIT", 300)
+        self.channel = getattr(
+            settings, "CLIENT_EMAIL_WAKEUP_CHANNEL", "codenerix_email"
+        )
+        self.using = using
+        self.listener = None
+
+    def notify(self):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(f'NOTIFY "{self.channel}"')
+
+    def listen(self):
+        # Use a connection of our own, so LISTEN is not affected by the
+        # transactions of the daemon
+        connection = connections[self.using]
+        self.listener = connection.get_new_connection(
+            connection.get_connection_params()
+        )
+        self.listener.autocommit = True
+        cursor = self.listener.cursor()
+        cursor.execute(f'LISTEN "{self.channel}"')
+        cursor.close()
+
+    def wait(self, timeout):
+        if self.listener is None:
+            self.listen()
+
+        if hasattr(self.listener, "poll"):
+            # psycopg2
+            (ready, _, _) = select.select([self.listener], [], [], timeout)
+            if ready:
+                self.listener.poll()
+                notified = bool(self.listener.notifies)
+                self.listener.notifies.clear()
+                return notified
+            return False
+        else:
+            # psycopg (3)
+            notified = False
+            for _ in self.listener.notifies(timeout=timeout, stop_after=1):
+                notified = True
+            return notified
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+
+_channel = None
+_channel_lock = threading.Lock()
+
+
+def get_channel():
+    """
+    Return the wakeup channel configured in CLIENT_EMAIL_WAKEUP
+    """
+    global _channel
+    with _channel_lock:
+        if _channel is None:
+            path = getattr(settings, "CLIENT_EMAIL_WAKEUP", None)
+            if path:
+                _channel = import_string(CHANNELS.get(path, path))()
+            else:
+                _channel = WakeupChannel()
+        return _channel
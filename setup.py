@@ -46,4 +46,7 @@ setup(
         "django_codenerix_extensions>=4.0.4",
         "IMAPClient>=3.0.1",
     ],
+    extras_require={
+        "async": ["aiosmtplib>=3.0"],
+    },
 )